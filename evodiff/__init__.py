@@ -6,5 +6,6 @@ from . import model
 from . import losses
 from . import data
 from . import metrics
+from . import samplers
 from . import pretrained
 from . import plot
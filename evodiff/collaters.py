@@ -4,54 +4,90 @@ from evodiff.utils import Tokenizer
 from sequence_models.constants import PAD, PROTEIN_ALPHABET, GAP
 
 
-def _pad(tokenized, value, dim=2):
+def onehot_tokens(tokenized, K, dtype=torch.double):
     """
-    Utility function that pads batches to the same length.
+    One hot encode token ids into K categories, rows of zeros for ids >= K (padding and special tokens)
+    """
+    valid = (tokenized < K).unsqueeze(-1)
+    output = torch.zeros(tokenized.shape + (K,), dtype=dtype, device=tokenized.device)
+    return output.scatter_(-1, tokenized.clamp(max=K - 1).unsqueeze(-1), valid.to(dtype))
+
 
-    tokenized: list of tokenized sequences
-    value: pad index
+def sample_transition_tokens(tokenized, timesteps, Q_bar, K, pad_id):
+    """
+    Batched forward noising by gathering rows of Q_bar[t] with token ids instead of multiplying one hots,
+    x_t ~ Q_bar[t][x_0] at every non-pad position
+    inputs:
+        tokenized: (B, ...) token ids, padded with pad_id
+        timesteps: (B,) timestep of each sample
+        Q_bar: (T, K, K) cumulative transition matrices, dtype sets the precision of q_x
+    returns sample and probabilities, pad_id and zeros at padding
+    """
+    nonpad = tokenized != pad_id
+    t = timesteps.view(-1, *[1] * (tokenized.dim() - 1))
+    q_x = Q_bar[t, tokenized.clamp(max=K - 1)].mul_(nonpad.unsqueeze(-1)) # (B, ..., K)
+    # Inverse CDF sampling, same distribution as torch.multinomial but much faster for many rows of few categories
+    cdf = q_x[nonpad].cumsum(-1)
+    u = torch.rand((cdf.shape[0], 1), dtype=cdf.dtype, device=cdf.device) * cdf[:, -1:]
+    src = torch.full_like(tokenized, pad_id)
+    src[nonpad] = torch.searchsorted(cdf, u, right=True).squeeze(1).clamp(max=K - 1)
+    return src, q_x
+
+
+def d3pm_noise(tokenized, timesteps, Q_bar, K, pad_id, dtype=torch.double):
+    """
+    Forward noising for batches from D3PM collaters with noise=False, runs on the device of the inputs so Q_bar can
+    stay resident there
+    inputs:
+        tokenized: (B, L) or (B, R, L) target token ids, padded with pad_id
+        timesteps: (B,) timestep of each sample
+        Q_bar: (T, K, K) cumulative transition matrices
+    returns src and q_x as in D3PMCollater, the D3PM losses take token ids so no one hots are built
     """
-    batch_size = len(tokenized)
-    max_len = max(len(t) for t in tokenized)
-    if dim == 3: # dim = 3 (one hot)
-        categories = tokenized[0].shape[-1]
-        output = torch.zeros((batch_size, max_len, categories)) + value
-        for row, t in enumerate(tokenized):
-            output[row, :len(t), :] = t
-    elif dim == 2: # dim = 2 (tokenized)
-        output = torch.zeros((batch_size, max_len)) + value
-        for row, t in enumerate(tokenized):
-            output[row, :len(t)] = t
-    else:
-        print("padding not supported for dim > 3")
-    return output
-
-def _pad_msa(tokenized, num_seq, max_len, value, dim=3):
-    """Utility function that pads batches to the same length."""
-    batch_size = len(tokenized)
-    if dim == 4: # one hot MSA
-        categories = tokenized[0].shape[-1] # last dim is one hot
-        output = torch.zeros((batch_size, num_seq, max_len, categories), dtype=torch.long) + value
-        for i in range(batch_size):
-            output[i, :, :len(tokenized[i][0]), :] = tokenized[i]
-    elif dim == 3: # tokenized MSA
-        output = torch.zeros((batch_size, num_seq, max_len), dtype=torch.long) + value
-        for i in range(batch_size):
-            output[i, :, :len(tokenized[i][0])] = tokenized[i]
-    else:
-        print("padding not supported for dim > 4")
-    return output
-
-
-def sample_transition_matrix(x_0, Q_bar):
+    src, q_x = sample_transition_tokens(tokenized, timesteps, Q_bar, K, pad_id)
+    return src, q_x.to(dtype)
+
+
+def _sample_timesteps(num_timesteps, size, timestep_sampler=None):
+    "Uniform timesteps in [1, num_timesteps) with weights None, or (timesteps, weights) from a timestep sampler"
+    if timestep_sampler is not None:
+        return timestep_sampler.sample(size)
+    return torch.from_numpy(np.random.randint(1, num_timesteps, size=size)), None # randomly sample timestep
+
+
+def _with_weights(outputs, weights):
+    "Append importance weights from a timestep sampler to collater outputs, unchanged without a sampler"
+    return outputs if weights is None else outputs + (weights,)
+
+
+def _random_mask(valid, num_mask):
     """
-    Sample a markov transition according to next_step = x_0 * q ^ time,
-    where Q_bar = q ^t or cumprod of scheduled transition matrices
-    returns sample and probabilities
+    Mask a uniformly random subset of num_mask[i] valid positions in each row: the num_mask smallest of random keys,
+    with keys of invalid positions set to inf so they are never picked
+    inputs:
+        valid: (B, N) bool array of positions that may be masked
+        num_mask: (B,) number of positions to mask per row, <= valid.sum(1)
+    returns (B, N) bool tensor
     """
-    p_next_step = torch.mm(x_0, Q_bar)
-    next_step = torch.multinomial(p_next_step, num_samples=1)
-    return next_step.squeeze(), p_next_step # sample and probabilities
+    keys = np.random.random(valid.shape)
+    keys[~valid] = np.inf
+    thresholds = np.take_along_axis(np.sort(keys, axis=1), np.maximum(num_mask - 1, 0)[:, None], axis=1)
+    return torch.from_numpy((keys <= thresholds) & (num_mask[:, None] > 0))
+
+
+def _esm_table(alphabet):
+    "byte -> index lookup table for the single character tokens of an ESM alphabet, unk_idx for anything else"
+    table = np.full(256, alphabet.unk_idx, dtype=np.int64)
+    for tok, idx in alphabet.tok_to_idx.items():
+        if len(tok) == 1 and ord(tok) < 256:
+            table[ord(tok)] = idx
+    return table
+
+
+def _esm_tokenize(table, seqs):
+    "Lookup-table tokenization of a list of equal length strings into a (N, L) int64 array"
+    data = ''.join(seqs).encode('latin-1', errors='replace')
+    return table[np.frombuffer(data, dtype=np.uint8)].reshape(len(seqs), -1)
 
 
 class OAMaskCollater(object):
@@ -75,36 +111,61 @@ class OAMaskCollater(object):
         self.tokenizer = tokenizer
 
     def __call__(self, sequences):
-        tokenized = [torch.tensor(self.tokenizer.tokenize(s)) for s in sequences]
-        max_len = max(len(t) for t in tokenized)
-        src=[]
-        timesteps = []
-        masks=[]
-        mask_id = torch.tensor(self.tokenizer.mask_id, dtype=torch.int64)
-        for i,x in enumerate(tokenized):
-            # Randomly generate timestep and indices to mask
-            D = len(x) # D should have the same dimensions as each sequence length
-            if D <= 1:  # for sequence length = 1 in dataset
-                t = 1
-            else:
-                t = np.random.randint(1, D) # randomly sample timestep
-            num_mask = (D-t+1) # from OA-ARMS
-            # Append timestep
-            timesteps.append(num_mask)
-            # Generate mask
-            mask_arr = np.random.choice(D, num_mask, replace=False) # Generates array of len num_mask
-            index_arr = np.arange(0, max_len) #index array [1...seq_len]
-            mask = np.isin(index_arr, mask_arr, invert=False).reshape(index_arr.shape) # mask bools indices specified by mask_arr
-            # Mask inputs
-            mask = torch.tensor(mask, dtype=torch.bool)
-            masks.append(mask)
-            x_t = ~mask[0:D] * x + mask[0:D] * mask_id
-            src.append(x_t)
-        # PAD out
-        src = _pad(src, self.tokenizer.pad_id)
-        masks = _pad(masks*1,0) #, self.seq_length, 0)
-        tokenized = _pad(tokenized, self.tokenizer.pad_id)
-        return (src.to(torch.long), torch.tensor(timesteps), tokenized.to(torch.long), masks)
+        tokenized = self.tokenizer.tokenize_batch([s[0] for s in sequences]) # nested lists, as in tokenize
+        D = np.array([len(s[0]) for s in sequences]) # sequence lengths
+        # Randomly generate timesteps, t = 1 for sequence length <= 1 in dataset
+        t = np.random.randint(1, np.maximum(D, 2))
+        num_mask = D - t + 1 # from OA-ARMS
+        masks = _random_mask(np.arange(tokenized.shape[1]) < D[:, None], num_mask)
+        tokenized = torch.from_numpy(tokenized)
+        src = torch.where(masks, self.tokenizer.mask_id, tokenized)
+        return (src, torch.from_numpy(num_mask), tokenized, masks.to(torch.float))
+
+def pack_index(lengths, max_len, pack_len=1024):
+    """
+    First-fit decreasing assignment of sequences to rows of pack_len positions (at least the longest sequence)
+    inputs:
+        lengths: (B,) array of sequence lengths
+        max_len: length of the padded (B, max_len) batch
+    returns (R, pack_len) int64 tensor of flat positions into the padded batch, -1 where a row is empty
+    """
+    pack_len = max(pack_len, int(lengths.max()))
+    rows, free = [], []
+    for i in np.argsort(-lengths, kind='stable'):
+        if lengths[i] == 0:
+            continue
+        r = next((r for r, space in enumerate(free) if space >= lengths[i]), len(rows))
+        if r == len(rows):
+            rows.append([])
+            free.append(pack_len)
+        rows[r].append(i)
+        free[r] -= lengths[i]
+    index = np.full((max(len(rows), 1), pack_len), -1, dtype=np.int64)
+    for r, row in enumerate(rows):
+        start = 0
+        for i in row:
+            index[r, start:start + lengths[i]] = i * max_len + np.arange(lengths[i])
+            start += lengths[i]
+    return torch.from_numpy(index)
+
+
+class PackingCollater(object):
+    """
+    Wraps a sequence collater (OAMaskCollater, D3PMCollater) and appends a pack_index to its outputs, so ByteNetLMTime
+    can run on rows of pack_len positions holding several sequences instead of one padded row per sequence.
+    All other outputs keep the padded per sequence layout, so losses are still attributed per sequence.
+    """
+    def __init__(self, collater, pack_len=1024):
+        self.collater = collater
+        self.tokenizer = collater.tokenizer
+        self.pack_len = pack_len
+
+    def __call__(self, sequences):
+        outputs = self.collater(sequences)
+        tokens = outputs[0] # src, or tokenized without noise, padded with pad_id
+        lengths = (tokens != self.tokenizer.pad_id).sum(1).numpy()
+        return outputs + (pack_index(lengths, tokens.shape[1], self.pack_len),)
+
 
 class D3PMCollater(object):
     """
@@ -114,6 +175,11 @@ class D3PMCollater(object):
         tokenizer: Tokenizer()
         masking scheme: 'BLOSUM' uses blosum matrix, 'RANDOM' uses uniform transition matrix
         num_timesteps: number of diffusion timesteps
+        dtype: precision of q_x and the one hot outputs
+        onehot: if False, src_one_hot and tgt_one_hot are None, the D3PM losses take src and tokenized ids
+        noise: if False, only return (tokenized, timesteps) and leave noising to d3pm_noise on the training device
+        timestep_sampler: optional LossAwareTimestepSampler, timesteps are drawn from it instead of uniformly and its
+            importance weights are appended to the outputs
 
     outputs:
         src : source  masked sequences (model input)
@@ -123,52 +189,33 @@ class D3PMCollater(object):
         Q : markov matrix
         q_x : forward transition probabilities
     """
-    def __init__(self, tokenizer=Tokenizer(), num_timesteps=100, Q=None, Q_bar=None):
+    def __init__(self, tokenizer=Tokenizer(), num_timesteps=100, Q=None, Q_bar=None, dtype=torch.double, onehot=True,
+                 noise=True, timestep_sampler=None):
         self.tokenizer = tokenizer
         self.num_timesteps = num_timesteps # Only needed for markov trans, doesnt depend on seq len
         self.K = self.tokenizer.K
         self.Q = Q
         self.Q_bar =Q_bar
+        self.dtype = dtype
+        self.onehot = onehot
+        self.noise = noise
+        self.timestep_sampler = timestep_sampler
+        self._Q_bar = Q_bar.to(dtype) if Q_bar is not None else None
 
     def __call__(self, sequences):
-        # Pre pad one-hot arrays
-        pad_one_hot = torch.zeros((self.K))
-
-        tokenized = [torch.tensor(self.tokenizer.tokenize(s)) for s in sequences]
-
-        max_len = max(len(t) for t in tokenized)
-
-        one_hot = pad_one_hot.repeat((len(tokenized), max_len, 1))
-        ## This is to deal with an empty sequence ##
-        del_index = None
-        for i,t in enumerate(tokenized):
-            if len(t) == 0:
-               del_index = i
-            else:
-                one_hot[i, :len(t), :] = self.tokenizer.one_hot(t)
-        if del_index is not None:
-           tokenized.pop(del_index)
-           one_hot = torch.cat((one_hot[:del_index], one_hot[del_index + 1:]))
-        one_hot = one_hot.to(torch.double)
-        src=[]
-        timesteps = []
-        q_x = pad_one_hot.repeat((len(tokenized), max_len, 1))
-        src_one_hot = pad_one_hot.repeat((len(tokenized), max_len, 1))
-        for i,t in enumerate(tokenized): # enumerate over batch
-            D = len(t)  # sequence length
-            x = one_hot[i, :D, :] #self.tokenizer.one_hot(t)
-            t = np.random.randint(1, self.num_timesteps) # randomly sample timestep
-            # Append timestep
-            timesteps.append(t)
-            # Calculate forward at time t and t-1
-            x_t, q_x_t = sample_transition_matrix(x, self.Q_bar[t]) # x = tgt, x_t = src, Q_bar[t] is cum prod @ time t
-            src.append(x_t)
-            src_one_hot[i, :D, :] = self.tokenizer.one_hot(x_t)
-            q_x[i, :D, :] = q_x_t
-        src = _pad(src, self.tokenizer.pad_id)
-        tokenized = _pad(tokenized, self.tokenizer.pad_id)
-        return (src.to(torch.long), src_one_hot.to(torch.double), torch.tensor(timesteps), tokenized.to(torch.long),
-                one_hot.to(torch.double), self.Q, self.Q_bar, q_x.to(torch.double)) #, q_x_minus1.to(torch.double))
+        ## Drop empty sequences ##
+        tokenized = self.tokenizer.tokenize_batch([s[0] for s in sequences if len(s[0]) > 0]) # nested lists
+        tokenized = torch.from_numpy(tokenized)
+        timesteps, weights = _sample_timesteps(self.num_timesteps, len(tokenized), self.timestep_sampler)
+        if not self.noise:
+            return _with_weights((tokenized, timesteps), weights)
+        # Calculate forward at time t, x = tgt, x_t = src, Q_bar[t] is cum prod @ time t
+        src, q_x = sample_transition_tokens(tokenized, timesteps, self._Q_bar, self.K, self.tokenizer.pad_id)
+        src_one_hot, one_hot = None, None
+        if self.onehot:
+            src_one_hot = onehot_tokens(src, self.K, self.dtype)
+            one_hot = onehot_tokens(tokenized, self.K, self.dtype)
+        return _with_weights((src, src_one_hot, timesteps, tokenized, one_hot, self.Q, self.Q_bar, q_x), weights)
 
 
 class D3PMCollaterMSA(object):
@@ -188,140 +235,94 @@ class D3PMCollaterMSA(object):
         Q : markov matrix
         Q_bar: cumulative prod of markov matrix
         q_x : forward transition probabilities
+
+    With onehot=False src_one_hot and tgt_one_hot are None, the D3PM losses take src and tokenized ids
+    With noise=False only (tokenized, timesteps) are returned and noising is left to d3pm_noise on the training device
+    With a timestep_sampler (LossAwareTimestepSampler) timesteps are drawn from it and its weights are appended
     """
-    def __init__(self, tokenizer=Tokenizer(), num_timesteps=100, Q=None, Q_bar=None, num_seqs=64):
+    def __init__(self, tokenizer=Tokenizer(), num_timesteps=100, Q=None, Q_bar=None, num_seqs=64, onehot=True,
+                 noise=True, timestep_sampler=None):
         self.tokenizer = tokenizer
         self.num_timesteps = num_timesteps  # Only needed for markov trans, doesnt depend on seq len
         self.K = self.tokenizer.K
         self.Q = Q
         self.Q_bar = Q_bar
         self.num_seqs = num_seqs
+        self.onehot = onehot
+        self.noise = noise
+        self.timestep_sampler = timestep_sampler
+
+    def _tokenize(self, msas):
+        "Tokenize a batch of MSAs into one (B, num_seqs, max_seq_len) tensor padded with pad_id"
+        max_seq_len = max(len(t[0]) for t in msas)  # all seqs in MSA are the same len
+        tokenized = np.full((len(msas), self.num_seqs, max_seq_len), self.tokenizer.pad_id, dtype=np.int64)
+        for i, msa in enumerate(msas):
+            tokenized[i, :, :len(msa[0])] = self.tokenizer.tokenize_batch(msa)
+        return torch.from_numpy(tokenized)
 
     def __call__(self, msas):
-        batch_size = len(msas)
-        tokenized = list(msas)  # tgt
-
-        # Init arrays to save too
-        max_seq_len = max(len(t[0]) for t in tokenized)  # all seqs in MSA are the same len
-        timesteps = []
-        src = tokenized.copy()
-        src_one_hot = tokenized.copy()
-        tgt_one_hot = tokenized.copy()
-        pad_one_hot = torch.zeros((self.K)) # prepad one hot tensor for saving
-        q_x = pad_one_hot.repeat((batch_size, self.num_seqs, max_seq_len, 1))
-
-        for i in range(batch_size):  # enumerate over batch
-            tokenized[i] = [torch.tensor(self.tokenizer.tokenizeMSA(s)) for s in msas[i]]
-            tgt_one_hot[i] = [self.tokenizer.one_hot(t) for t in tokenized[i]]
-            curr_msa = torch.stack(tgt_one_hot[i])
-            length, depth, tokens = curr_msa.shape  # length = number of seqs in MSA, depth = # AA in MSA
-            curr_msa = curr_msa.flatten(start_dim=0, end_dim=1)
-            # Append timestep
-            t = np.random.randint(1, self.num_timesteps)  # randomly sample timestep
-            timesteps.append(t)
-            # Calculate target
-            x_t, q_x_t = sample_transition_matrix(curr_msa, self.Q_bar[t])  # x = tgt, x_t = src, Q_bar accounts for time
-            # Reshape back to MSA
-            x_t = x_t.reshape(length, depth)
-            #print(q_x_t.shape)
-            q_x_t = q_x_t.reshape(length, depth, tokens)
-            src[i] = x_t
-            src_one_hot[i] = [self.tokenizer.one_hot(t) for t in x_t]
-            q_x[i, :, :depth, :] = q_x_t
-            tokenized[i] = torch.stack(tokenized[i])  #replace list with stack
-            src_one_hot[i] = torch.stack(src_one_hot[i])
-            tgt_one_hot[i] = torch.stack(tgt_one_hot[i])
-        # PAD out
-        src = _pad_msa(src, self.num_seqs, max_seq_len, self.tokenizer.pad_id)
-        tokenized = _pad_msa(tokenized, self.num_seqs, max_seq_len, self.tokenizer.pad_id)
-        src_one_hot = _pad_msa(src_one_hot, self.num_seqs, max_seq_len, self.tokenizer.pad_id, dim=4)
-        tgt_one_hot = _pad_msa(tgt_one_hot, self.num_seqs, max_seq_len, self.tokenizer.pad_id, dim=4)
-        return (src.to(torch.long), src_one_hot.to(torch.double), torch.tensor(timesteps), tokenized.to(torch.long),
-                tgt_one_hot.to(torch.double), self.Q, self.Q_bar, q_x.to(torch.double))
+        timesteps, weights = _sample_timesteps(self.num_timesteps, len(msas), self.timestep_sampler)
+        tokenized = self._tokenize(msas) # tgt
+        if not self.noise:
+            return _with_weights((tokenized, timesteps), weights)
+        # Calculate target for the whole batch with one gather, x = tgt, x_t = src, Q_bar accounts for time
+        src, q_x = sample_transition_tokens(tokenized, timesteps, self.Q_bar, self.K, self.tokenizer.pad_id)
+        src_one_hot, tgt_one_hot = None, None
+        if self.onehot:
+            src_one_hot = onehot_tokens(src, self.K, self.Q_bar.dtype)
+            tgt_one_hot = onehot_tokens(tokenized, self.K, self.Q_bar.dtype)
+        return _with_weights((src, src_one_hot, timesteps, tokenized, tgt_one_hot, self.Q, self.Q_bar, q_x), weights)
 
 
 class ESMOAMaskCollater(object):
     "Wrapped for OA Collater to operate on ESM w/ ESM alphabet and batch converter/tokens"
     def __init__(self, alphabet):
         self.alphabet= alphabet
-        self.batch_converter = alphabet.get_batch_converter()
+        self.table = _esm_table(alphabet)
+
     def __call__(self, sequences):
-        input_data = [("protein0", sequences[0][0])]
-        batch_labels, batch_strs, sample = self.batch_converter(input_data)
-        #print(batch_labels, batch_strs, sample)
-        #print("CLS, EOS INDEX", self.alphabet.cls_idx, self.alphabet.eos_idx)
-        max_len = max(len(t) for t in sample)
-        src=[]
-        timesteps = []
-        masks=[]
-        mask_id = torch.tensor(self.alphabet.mask_idx, dtype=torch.int64)
-        for i,x in enumerate(sample):
-            # Randomly generate timestep and indices to mask
-            D = len(x) # D should have the same dimensions as each sequence length, minus start stop token
-            t = np.random.randint(1, D-1) # randomly sample timestep (don't want to sample start/stop token)
-            num_mask = (D-t+1) # from OA-ARMS
-            # Append timestep
-            timesteps.append(num_mask)
-            # Generate mask
-            mask_arr = np.random.choice(D, num_mask, replace=False) # Generates array of len num_mask
-            index_arr = np.arange(0, max_len) #index array [1...seq_len]
-            mask = np.isin(index_arr, mask_arr, invert=False).reshape(index_arr.shape) # mask bools indices specified by mask_arr
-            # Mask inputs
-            mask = torch.tensor(mask, dtype=torch.bool)
-            masks.append(mask)
-            x_t = ~mask * x + mask * mask_id
-            src.append(x_t)
-            #print(x_t)
-        # PAD out
-        src = _pad(src, self.alphabet.padding_idx)
-        masks = _pad(masks*1,0) #, self.seq_length, 0)
-        tokenized = _pad(sample, self.alphabet.padding_idx)
-        return (src.to(torch.long), torch.tensor(timesteps), tokenized.to(torch.long), masks)
+        seqs = [s[0] for s in sequences]
+        lengths = np.array([len(seq) for seq in seqs])
+        start = int(self.alphabet.prepend_bos)
+        D = lengths + start + int(self.alphabet.append_eos) # sequence length with start/stop token
+        # Tokenize as the ESM batch converter does: <cls> seq <eos>, padded
+        sample = np.full((len(seqs), D.max()), self.alphabet.padding_idx, dtype=np.int64)
+        if start:
+            sample[:, 0] = self.alphabet.cls_idx
+        positions = np.arange(lengths.max())
+        sample[:, start:start + lengths.max()][positions < lengths[:, None]] = self.table[
+            np.frombuffer(''.join(seqs).encode('latin-1', errors='replace'), dtype=np.uint8)]
+        if self.alphabet.append_eos:
+            sample[np.arange(len(seqs)), lengths + start] = self.alphabet.eos_idx
+        # Randomly generate timestep and indices to mask
+        t = np.random.randint(1, D - 1) # randomly sample timestep (don't want to sample start/stop token)
+        num_mask = D - t + 1 # from OA-ARMS
+        masks = _random_mask(np.arange(sample.shape[1]) < D[:, None], num_mask)
+        sample = torch.from_numpy(sample)
+        src = torch.where(masks, self.alphabet.mask_idx, sample)
+        return (src, torch.from_numpy(num_mask), sample, masks.to(torch.float))
 
 
 class ESMOAMaskCollaterMSA(object):
     "Wrapped for OA Collater to operate on ESM MSA w/ ESM alphabet and batch converter/tokens"
     def __init__(self, alphabet, num_seqs=64):
         self.alphabet= alphabet
-        self.batch_converter = alphabet.get_batch_converter()
+        self.table = _esm_table(alphabet)
         self.num_seqs = num_seqs
+
     def __call__(self, msa_batch):
-        input_data = [("seq"+str(i), seq) for i, seq in enumerate(msa_batch[0])]
-        batch_labels, batch_strs, sample = self.batch_converter(input_data)
-        #print([len(seq) for seq in batch_strs[0]])
-        tgt = [[[self.alphabet.get_idx(c) for c in [*seq]] for seq in msa] for msa in batch_strs]
-        #tgt = sample
-        #print(sample[0][0])
-        #print(tgt[0][0])
-        #print("CLS, EOS INDEX", self.alphabet.cls_idx, self.alphabet.eos_idx)
-
-        #print(batch_strs[0][0])
-        #print([[''.join([self.alphabet.get_tok(s) for s in seq]) for seq in tgt[0]]])
-
-        src = tgt.copy()
-        #tgt = torch.Tensor(tgt).long()
-        longest_msa = 0
-        for i,x in enumerate(src):
-            x = torch.Tensor(x)
-            length, depth = x.shape
-            x = x.flatten()
-            # Randomly generate timestep and indices to mask
-            D = len(x) # D should have the same dimensions as each sequence length
-            t = np.random.randint(1, D) # randomly sample timestep
-            num_mask = (D-t+1) # from OA-ARMS
-            # Generate mask
-            mask_idx = np.random.choice(D, num_mask, replace=False)
-            x[mask_idx] = self.alphabet.mask_idx
-            x = x.reshape(length, depth)
-            src[i] = x
-            longest_msa = max(depth, longest_msa)
-            #print(x_t)
-        # PAD out
-        src = torch.stack(src) # No batches #_pad_msa(src, self.num_seqs, self.alphabet.padding_idx, longest_msa)
-        tgt = torch.tensor(tgt)
-        # print(src.shape, tgt.shape)
-        # print(src[0][0], tgt[0][0])
-        #print([[''.join([self.alphabet.get_tok(s) for s in seq]) for seq in src[0]]])
-        #print([[''.join([self.alphabet.get_tok(s) for s in seq]) for seq in tgt[0]]])
-        masks = (src == self.alphabet.mask_idx)
-        return (src.to(torch.long), tgt, masks)
+        depths = np.array([len(msa) for msa in msa_batch])
+        lengths = np.array([len(msa[0]) for msa in msa_batch])
+        tgt = np.full((len(msa_batch), depths.max(), lengths.max()), self.alphabet.padding_idx, dtype=np.int64)
+        for i, msa in enumerate(msa_batch):
+            tgt[i, :depths[i], :lengths[i]] = _esm_tokenize(self.table, msa)
+        # Randomly generate timestep and indices to mask over each flattened MSA
+        valid = ((np.arange(depths.max())[:, None] < depths[:, None, None]) &
+                 (np.arange(lengths.max()) < lengths[:, None, None]))
+        D = depths * lengths
+        t = np.random.randint(1, D) # randomly sample timestep
+        num_mask = D - t + 1 # from OA-ARMS
+        masks = _random_mask(valid.reshape(len(msa_batch), -1), num_mask).reshape(tgt.shape)
+        tgt = torch.from_numpy(tgt)
+        src = torch.where(masks, self.alphabet.mask_idx, tgt)
+        return (src, tgt, masks)
@@ -12,7 +12,7 @@ from tqdm import tqdm
 import pandas as pd
 import random
 from evodiff.plot import aa_reconstruction_parity_plot, idr_parity_plot
-from scipy.spatial.distance import hamming, cdist
+from evodiff.data import subsample_max_hamming
 
 def main():
     # set seeds
@@ -459,29 +459,7 @@ def subsample_MSA(save_idx, data_top_dir, pdb, start_idxs, end_idxs, tokenizer,
                 output = np.concatenate((anchor_seq, np.array(sliced_msa)[random_idx.astype(int)]), axis=0)
             elif selection_type == "MaxHamming":
                 print("using MaxHamming subsampling")
-                output = [list(anchor_seq)]
-                msa_subset = sliced_msa
-                msa_ind = np.arange(msa_num_seqs-1)
-                random_ind = np.random.choice(msa_ind)
-                random_seq = sliced_msa[random_ind]
-                output.append(list(random_seq))
-                random_seq = np.expand_dims(random_seq, axis=0)
-                msa_subset = np.delete(msa_subset, (random_ind), axis=0)
-                m = len(msa_ind) - 1
-                distance_matrix = np.ones((n_sequences - 2, m))
-                for i in range(n_sequences - 2):
-                    curr_dist = cdist(random_seq, msa_subset, metric='hamming')
-                    curr_dist = np.expand_dims(np.array(curr_dist), axis=0)  # shape is now (1,msa_num_seqs)
-                    #print(curr_dist.shape)
-                    distance_matrix[i] = curr_dist
-                    col_min = np.min(distance_matrix, axis=0)  # (1,num_choices)
-                    max_ind = np.argmax(col_min)
-                    random_ind = max_ind
-                    random_seq = msa_subset[random_ind]
-                    output.append(list(random_seq))
-                    random_seq = np.expand_dims(random_seq, axis=0)
-                    msa_subset = np.delete(msa_subset, random_ind, axis=0)
-                    distance_matrix = np.delete(distance_matrix, random_ind, axis=1)
+                output = subsample_max_hamming(anchor_seq, sliced_msa, n_sequences)
         else:
             #msa_n_sequences = msa_num_seqs
             output = np.full(shape=(n_sequences, max_seq_len), fill_value=tokenizer.gap_id) # Treat short seqs as being algined with large gaps
@@ -1024,31 +1002,7 @@ def subsample_IDR_MSA(index_file, tokenizer, max_seq_len=512, n_sequences=64, se
             output = np.concatenate((anchor_seq, np.array(sliced_msa)[random_idx.astype(int)]), axis=0)
         elif selection_type == "MaxHamming":
             print("using MaxHamming subsampling")
-            output = [list(anchor_seq)]
-            msa_subset = sliced_msa
-            msa_ind = np.arange(msa_num_seqs-1)
-            random_ind = np.random.choice(msa_ind)
-            random_seq = sliced_msa[random_ind]
-            output.append(list(random_seq))
-            random_seq = np.expand_dims(random_seq, axis=0)
-            msa_subset = np.delete(msa_subset, (random_ind), axis=0)
-            m = len(msa_ind) - 1
-            distance_matrix = np.ones((n_sequences - 2, m))
-            #print("msa subset", msa_subset.shape, msa_num_seqs, len(msa_ind))
-            #print(distance_matrix.shape)
-            for i in range(n_sequences - 2):
-                curr_dist = cdist(random_seq, msa_subset, metric='hamming')
-                curr_dist = np.expand_dims(np.array(curr_dist), axis=0)  # shape is now (1,msa_num_seqs)
-                #print(curr_dist.shape)
-                distance_matrix[i] = curr_dist
-                col_min = np.min(distance_matrix, axis=0)  # (1,num_choices)
-                max_ind = np.argmax(col_min)
-                random_ind = max_ind
-                random_seq = msa_subset[random_ind]
-                output.append(list(random_seq))
-                random_seq = np.expand_dims(random_seq, axis=0)
-                msa_subset = np.delete(msa_subset, random_ind, axis=0)
-                distance_matrix = np.delete(distance_matrix, random_ind, axis=1)
+            output = subsample_max_hamming(anchor_seq, sliced_msa, n_sequences)
     else:
         print("N_SEQ < MSA SEQUENCES")
         msa_n_sequences = msa_num_seqs
@@ -1,7 +1,10 @@
 import os
+import string
+import hashlib
+import tempfile
+import zipfile
 from pathlib import Path
 from tqdm import tqdm
-from scipy.spatial.distance import hamming, cdist
 
 import numpy as np
 from torch.utils.data import Dataset
@@ -14,6 +17,164 @@ from collections import Counter
 import torch
 import os
 from torch.utils.data import Subset
+from multiprocessing import Pool
+
+_A3M_ALIGNED = set(string.ascii_uppercase + GAP) # lowercase insertions and '.' are dropped
+_A3M_DELETE = bytes(b for b in range(256) if chr(b) not in _A3M_ALIGNED) # also line breaks, '\r' of CRLF files
+
+
+def _a3m_table(tokenizer):
+    """
+    Returns bytes to delete when stripping an A3M row, and a 256-entry byte -> token lookup array for tokenizer
+    (unmapped bytes are 255)
+    """
+    lookup = np.where(tokenizer.a_to_i_table < 0, 255, tokenizer.a_to_i_table).astype(np.uint8)
+    return _A3M_DELETE, lookup
+
+
+def read_a3m(path, tokenizer, return_names=False):
+    """
+    Byte-level A3M reader. Strips insertions (lowercase, '.') and tokenizes every aligned row in one pass
+
+    inputs:
+        path: path to .a3m file
+        tokenizer: Tokenizer used to map characters to tokens (must have fewer than 255 tokens)
+        return_names: if True, also return the header of each row
+
+    outputs:
+        msa: (N, L) uint8 array of tokens
+        names: list of N headers, only if return_names
+    """
+    delete, lookup = _a3m_table(tokenizer)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'>'):
+        data = data[1:]
+    names = []
+    rows = []
+    for record in data.split(b'\n>'):
+        header, _, body = record.partition(b'\n')
+        names.append(header.decode().rstrip('\r'))
+        rows.append(body.translate(None, delete))
+    length = len(rows[0])
+    if any(len(row) != length for row in rows):
+        raise ValueError("Rows of " + str(path) + " have different aligned lengths")
+    msa = lookup[np.frombuffer(b''.join(rows), dtype=np.uint8)].reshape(len(rows), length)
+    if (msa == 255).any():
+        raise ValueError("Found characters in " + str(path) + " that are not in the tokenizer alphabet")
+    if return_names:
+        return msa, names
+    return msa
+
+
+def remove_gap_rows(msa, gap_idx):
+    "Drop rows of a tokenized (N, L) MSA that only contain gaps"
+    return msa[(msa != gap_idx).any(axis=1)]
+
+
+def _a3m_records(f):
+    "Yield the aligned body of each record of an open binary A3M file, one record at a time"
+    body = None
+    for line in f:
+        if line.startswith(b'>'):
+            if body is not None:
+                yield b''.join(body)
+            body = []
+        elif body is not None:
+            body.append(line.rstrip(b'\r\n'))
+    if body is not None:
+        yield b''.join(body)
+
+
+def read_a3m_random(path, tokenizer, n_sequences, max_seq_len, query_idx=0):
+    """
+    Streaming A3M reader for random MSA subsampling. Picks a random max_seq_len window from the length of the first
+    row, then reservoir samples (Algorithm L) n_sequences - 1 of the rows that are not all gaps in that window (skipping the first
+    such row, as the datasets do), while reading. Only the kept rows are tokenized, so memory does not grow with MSA
+    depth.
+
+    inputs:
+        path: path to .a3m file
+        tokenizer: Tokenizer used to map characters to tokens (must have fewer than 255 tokens)
+        n_sequences: number of rows in the output
+        max_seq_len: maximum MSA sequence length
+        query_idx: row of the query sequence, always the first row of the output
+
+    outputs:
+        msa: (n, L) uint8 array of tokens. If there are more than n_sequences rows that are not all gaps, the query
+            followed by a random sample of n_sequences - 1 rows in random order, otherwise all of these rows in order
+        msa_num_seqs: number of rows that are not all gaps in the window
+    """
+    delete, lookup = _a3m_table(tokenizer)
+    gap = ord(GAP)
+    k = n_sequences - 1
+    reservoir = []
+    first = None
+    anchor = None
+    msa_num_seqs = 0
+    next_idx = -1
+    with open(path, 'rb') as f:
+        for i, body in enumerate(_a3m_records(f)):
+            body = body.translate(None, delete)
+            if i == 0:
+                length = len(body)
+                slice_start = np.random.choice(length - max_seq_len + 1) if length > max_seq_len else 0
+            elif len(body) != length:
+                raise ValueError("Rows of " + str(path) + " have different aligned lengths")
+            window = body[slice_start: slice_start + max_seq_len]
+            if i == query_idx:
+                anchor = window
+            if window.count(gap) == len(window):
+                continue
+            msa_num_seqs += 1
+            if first is None:
+                first = window
+            elif msa_num_seqs - 1 <= k:
+                reservoir.append(window)
+                if msa_num_seqs - 1 == k and k > 0: # Algorithm L: jump straight to the next row to replace
+                    w = np.exp(np.log(np.random.random()) / k)
+                    next_idx = k + int(np.log(np.random.random()) / np.log1p(-w)) + 1
+            elif msa_num_seqs - 1 == next_idx:
+                reservoir[np.random.randint(k)] = window
+                w *= np.exp(np.log(np.random.random()) / k)
+                next_idx += int(np.log(np.random.random()) / np.log1p(-w)) + 1
+    if msa_num_seqs > n_sequences:
+        np.random.shuffle(reservoir)
+        rows = [anchor] + reservoir
+    else:
+        rows = ([first] if first is not None else []) + reservoir
+    msa = lookup[np.frombuffer(b''.join(rows), dtype=np.uint8)].reshape(len(rows), -1)
+    if (msa == 255).any():
+        raise ValueError("Found characters in " + str(path) + " that are not in the tokenizer alphabet")
+    return msa, msa_num_seqs
+
+
+def subsample_max_hamming(anchor_seq, candidates, n_sequences):
+    """
+    Greedy MaxHamming (farthest point) subsampling of an MSA. Starting from a random candidate, repeatedly adds the
+    candidate with the largest minimum Hamming distance to the sequences already picked (ties go to the lowest index).
+    Keeps a running min-distance vector instead of a distance matrix, so each pick is a single uint8 comparison.
+
+    inputs:
+        anchor_seq: (L,) tokenized query sequence, always the first row of the output
+        candidates: (N, L) tokenized sequences to choose from, N >= n_sequences - 1
+        n_sequences: number of rows in the output, including anchor_seq
+
+    outputs:
+        output: (n_sequences, L) array of anchor_seq followed by the selected candidates in order of selection
+    """
+    candidates = np.asarray(candidates)
+    packed = candidates.astype(np.uint8, copy=False) # tokens fit in a byte
+    selected = [np.random.choice(len(candidates))]
+    min_dist = np.full(len(candidates), packed.shape[1] + 1, dtype=np.int64)
+    min_dist[selected[0]] = -1 # never re-select
+    for _ in range(n_sequences - 2):
+        dist = np.count_nonzero(packed != packed[selected[-1]], axis=1)
+        np.minimum(min_dist, dist, out=min_dist)
+        next_ind = int(np.argmax(min_dist))
+        min_dist[next_ind] = -1
+        selected.append(next_ind)
+    return np.concatenate((np.expand_dims(anchor_seq, axis=0), candidates[selected]), axis=0)
 
 def subsample_msa(path_to_msa, n_sequences=64, max_seq_len=512, selection_type='random'):
     alphabet = PROTEIN_ALPHABET
@@ -24,15 +185,14 @@ def subsample_msa(path_to_msa, n_sequences=64, max_seq_len=512, selection_type='
     if not os.path.exists(path_to_msa):
         print("PATH TO MSA DOES NOT EXIST")
     path = path_to_msa
-    parsed_msa = parse_fasta(path)
-
-    aligned_msa = [[char for char in seq if (char.isupper() or char == '-') and not char == '.'] for seq in
-                   parsed_msa]
-    aligned_msa = [''.join(seq) for seq in aligned_msa]
-
-    tokenized_msa = [tokenizer.tokenizeMSA(seq) for seq in aligned_msa]
-    tokenized_msa = np.array([l.tolist() for l in tokenized_msa])
-    msa_seq_len = len(tokenized_msa[0])
+    if selection_type == 'random':
+        output, msa_num_seqs = read_a3m_random(path, tokenizer, n_sequences, max_seq_len)
+        if msa_num_seqs < n_sequences:
+            raise Exception("msa num_seqs < self.n_sequences, indicates dataset not filtered properly")
+        output = [''.join(seq) for seq in alpha[output]]
+        return output, output[0]
+    tokenized_msa = read_a3m(path, tokenizer)
+    msa_seq_len = tokenized_msa.shape[1]
 
     if msa_seq_len > max_seq_len:
         slice_start = np.random.choice(msa_seq_len - max_seq_len + 1)
@@ -46,7 +206,7 @@ def subsample_msa(path_to_msa, n_sequences=64, max_seq_len=512, selection_type='
     anchor_seq = sliced_msa_seq[0]  # This is the query sequence in MSA
 
     # slice out all-gap rows
-    sliced_msa = [seq for seq in sliced_msa_seq if (list(set(seq)) != [gap_idx])]
+    sliced_msa = remove_gap_rows(sliced_msa_seq, gap_idx)
     msa_num_seqs = len(sliced_msa)
 
     if msa_num_seqs < n_sequences:
@@ -59,29 +219,7 @@ def subsample_msa(path_to_msa, n_sequences=64, max_seq_len=512, selection_type='
             anchor_seq = np.expand_dims(anchor_seq, axis=0)
             output = np.concatenate((anchor_seq, np.array(sliced_msa)[random_idx.astype(int)]), axis=0)
         elif selection_type == "MaxHamming":
-            output = [list(anchor_seq)]
-            msa_subset = sliced_msa[1:]
-            msa_ind = np.arange(msa_num_seqs)[1:]
-            random_ind = np.random.choice(msa_ind)
-            random_seq = sliced_msa[random_ind]
-            output.append(list(random_seq))
-            random_seq = np.expand_dims(random_seq, axis=0)
-            msa_subset = np.delete(msa_subset, (random_ind - 1), axis=0)
-            m = len(msa_ind) - 1
-            distance_matrix = np.ones((n_sequences - 2, m))
-
-            for i in range(n_sequences - 2):
-                curr_dist = cdist(random_seq, msa_subset, metric='hamming')
-                curr_dist = np.expand_dims(np.array(curr_dist), axis=0)  # shape is now (1,msa_num_seqs)
-                distance_matrix[i] = curr_dist
-                col_min = np.min(distance_matrix, axis=0)  # (1,num_choices)
-                max_ind = np.argmax(col_min)
-                random_ind = max_ind
-                random_seq = msa_subset[random_ind]
-                output.append(list(random_seq))
-                random_seq = np.expand_dims(random_seq, axis=0)
-                msa_subset = np.delete(msa_subset, random_ind, axis=0)
-                distance_matrix = np.delete(distance_matrix, random_ind, axis=1)
+            output = subsample_max_hamming(anchor_seq, sliced_msa[1:], n_sequences)
     else:
         output = sliced_msa
 
@@ -124,6 +262,58 @@ def read_idr_files(data_dir, filename):
         raise Exception("Missing filepaths")
     return path
 
+DATASET_CACHE_VERSION = 2
+
+
+def _file_state(path):
+    "(mtime, size) of path, or None if it does not exist"
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def cached_metadata(cache_dir, key, build):
+    """
+    Load dataset metadata from cache_dir/dataset_cache_<hash of key>.npz, calling build() and saving its output on a
+    miss. key should describe the directory state and filter parameters the metadata depends on.
+
+    inputs:
+        cache_dir: directory to keep cache files in
+        key: tuple of repr-able values
+        build: function returning a dict of arrays
+
+    outputs:
+        dict of arrays
+    """
+    digest = hashlib.sha1(repr((DATASET_CACHE_VERSION,) + tuple(key)).encode()).hexdigest()[:16]
+    cache_file = os.path.join(cache_dir, 'dataset_cache_' + digest + '.npz')
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as f:
+                return {k: f[k] for k in f.files}
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile) as e: # unreadable cache, rebuild and rewrite it
+            print("Could not read dataset cache", cache_file, e)
+    metadata = build()
+    tmp_file = None
+    try:
+        # unique temporary file, every DDP rank may build the same cache at once
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix='.dataset_cache_' + digest + '-', suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **metadata)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print("Could not write dataset cache", cache_file, e)
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+    return metadata
+
+
+def _names_digest(names):
+    "Short digest of a list of filenames, to key caches on directory contents"
+    return hashlib.sha1('\n'.join(names).encode()).hexdigest()
+
+
 def get_msa_depth_lengths(data_dir, all_files, save_depth_file, save_length_file, idr=False):
     """
     Function to compute openfold and IDR dataset depths
@@ -164,6 +354,166 @@ def get_valid_msas(data_top_dir, data_dir='openfold/', selection_type='MaxHammin
     return ds_valid
 
 
+def write_msa_shards(data_dir, all_files, save_dir, shard_bytes=2 ** 32, idr=False, max_seq_len=512):
+    """
+    One-time conversion of MSAs to tokenized uint8 matrices stored back to back in a few large shard files
+    (msa_shard_<k>.bin), to be memory mapped by MSAShardDataset. The query sequence is written as the first row of
+    each MSA. Writes msa_shards_index.npz holding filenames, shard, offset, depth, length, gap_depth (rows with
+    <= max_seq_len gaps, as in build_msa_index), max_seq_len and query_idx (the row of the query sequence in the
+    original file).
+
+    inputs:
+        data_dir : path to directory with data
+        all_files: all filenames
+        save_dir: directory to write shards and index to
+        shard_bytes: start a new shard once the current one would exceed this size
+        idr: if True, read IDR files (query is located by name) instead of openfold files (query is the first row)
+        max_seq_len: gap threshold used for gap depth
+    """
+    tokenizer = Tokenizer(PROTEIN_ALPHABET)
+    gap_idx = tokenizer.alphabet.index(GAP)
+    os.makedirs(save_dir, exist_ok=True)
+    shards, offsets, depths, lengths, gap_depths, query_idxs = [], [], [], [], [], []
+    shard = 0
+    offset = 0
+    f_out = open(os.path.join(save_dir, 'msa_shard_%d.bin' % shard), 'wb')
+    for filename in tqdm(all_files):
+        if idr:
+            msa, names = read_a3m(read_idr_files(data_dir, filename), tokenizer, return_names=True)
+            query_idx = names.index(filename.split('_')[0])
+            msa = np.concatenate((msa[query_idx:query_idx + 1], msa[:query_idx], msa[query_idx + 1:]))
+        else:
+            msa = read_a3m(read_openfold_files(data_dir, filename), tokenizer)
+            query_idx = 0
+        if offset > 0 and offset + msa.nbytes > shard_bytes:
+            f_out.close()
+            shard += 1
+            offset = 0
+            f_out = open(os.path.join(save_dir, 'msa_shard_%d.bin' % shard), 'wb')
+        f_out.write(msa.tobytes())
+        shards.append(shard)
+        offsets.append(offset)
+        depths.append(msa.shape[0])
+        lengths.append(msa.shape[1])
+        gap_depths.append(int(((msa == gap_idx).sum(axis=1) <= max_seq_len).sum()))
+        query_idxs.append(query_idx)
+        offset += msa.nbytes
+    f_out.close()
+    np.savez(os.path.join(save_dir, 'msa_shards_index.npz'), filenames=np.array([str(f) for f in all_files]),
+             shard=np.asarray(shards), offset=np.asarray(offsets, dtype=np.int64), depth=np.asarray(depths),
+             length=np.asarray(lengths), gap_depth=np.asarray(gap_depths), max_seq_len=max_seq_len,
+             query_idx=np.asarray(query_idxs), alphabet=np.array(PROTEIN_ALPHABET))
+
+
+MSA_INDEX_FILE = 'msa_index.npz'
+MSA_INDEX_VERSION = 2 # 2: lengths of the aligned query row, as read_a3m parses it
+
+
+def _index_msa_file(args):
+    """
+    Depth, length, gap depth and query index of one MSA file, read in a single pass
+
+    inputs:
+        args: (path, max_seq_len, query_name); query_name is None when the query is the first row
+
+    outputs:
+        depth: number of sequences
+        length: aligned length of the first sequence, without insertions or line breaks like read_a3m
+        gap_depth: number of sequences with <= max_seq_len gaps
+        query_idx: row of the sequence named query_name (-1 if not found)
+    """
+    path, max_seq_len, query_name = args
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(b'>'):
+        data = data[1:]
+    depth = 0
+    gap_depth = 0
+    length = 0
+    query_idx = 0 if query_name is None else -1
+    for i, record in enumerate(data.split(b'\n>')):
+        header, _, body = record.partition(b'\n')
+        if i == 0:
+            length = len(body.translate(None, _A3M_DELETE))
+        if query_idx < 0 and header.decode().rstrip('\r') == query_name:
+            query_idx = i
+        depth += 1
+        gap_depth += body.count(GAP.encode()) <= max_seq_len
+    return depth, length, gap_depth, query_idx
+
+
+def build_msa_index(data_dir, all_files=None, save_file=MSA_INDEX_FILE, max_seq_len=512, idr=False,
+                    num_workers=None):
+    """
+    Builds (or updates) a single versioned index of depth, length, gap depth (rows with <= max_seq_len gaps) and
+    query index for every MSA. A3MMSADataset (openfold) and IDRDataset read it when it is present in data_dir, in place
+    of openfold_depths/lengths/gap_depths.npz and idr_depths/lengths/query_idxs.npz. Files are processed in parallel;
+    if save_file already exists with the same version and max_seq_len, only files whose mtime or size changed are
+    re-read.
+
+    inputs:
+        data_dir : path to directory with data
+        all_files: all filenames, default every non-.npz entry of data_dir
+        save_file: file to save index to (in data_dir)
+        max_seq_len: gap threshold used for gap depth
+        idr: if True, read IDR files (query located by name) instead of openfold files (query is the first row)
+        num_workers: number of processes, default os.cpu_count()
+    """
+    if all_files is None:
+        all_files = sorted(x for x in os.listdir(data_dir) if not x.endswith('.npz'))
+    all_files = [Path(f).name for f in all_files]
+    paths = [read_idr_files(data_dir, f) if idr else read_openfold_files(data_dir, f) for f in all_files]
+    stats = [os.stat(path) for path in paths]
+    mtimes = np.array([st.st_mtime_ns for st in stats], dtype=np.int64)
+    sizes = np.array([st.st_size for st in stats], dtype=np.int64)
+    values = np.full((len(all_files), 4), -1, dtype=np.int64) # depth, length, gap_depth, query_idx
+
+    # Reuse entries of unchanged files
+    stale = np.ones(len(all_files), dtype=bool)
+    if os.path.exists(data_dir + save_file):
+        old = np.load(data_dir + save_file)
+        if int(old['version']) == MSA_INDEX_VERSION and int(old['max_seq_len']) == max_seq_len:
+            old_pos = {f: i for i, f in enumerate(old['filenames'])}
+            for i, f in enumerate(all_files):
+                j = old_pos.get(f)
+                if j is not None and old['mtime'][j] == mtimes[i] and old['size'][j] == sizes[i]:
+                    values[i] = [old['depth'][j], old['length'][j], old['gap_depth'][j], old['query_idx'][j]]
+                    stale[i] = False
+    print("indexing", stale.sum(), "of", len(all_files), "MSAs")
+
+    stale_idx = np.flatnonzero(stale)
+    jobs = [(paths[i], max_seq_len, all_files[i].split('_')[0] if idr else None) for i in stale_idx]
+    if len(jobs) > 0:
+        with Pool(num_workers) as pool:
+            for i, v in zip(stale_idx, tqdm(pool.imap(_index_msa_file, jobs, chunksize=64), total=len(jobs))):
+                values[i] = v
+    np.savez(data_dir + save_file, version=MSA_INDEX_VERSION, max_seq_len=max_seq_len,
+             filenames=np.array(all_files), mtime=mtimes, size=sizes, depth=values[:, 0], length=values[:, 1],
+             gap_depth=values[:, 2], query_idx=values[:, 3])
+
+
+def load_msa_index(data_dir, filenames, max_seq_len, save_file=MSA_INDEX_FILE):
+    """
+    Look up depth, length, gap depth and query index of filenames in an index written by build_msa_index.
+    max_seq_len is the gap threshold the index must have been built with, None when gap depth is not used
+
+    outputs:
+        dict of arrays aligned with filenames
+    """
+    index = np.load(data_dir + save_file)
+    if int(index['version']) != MSA_INDEX_VERSION:
+        raise Exception(save_file + " has an old version, rerun build_msa_index")
+    if max_seq_len is not None and int(index['max_seq_len']) != max_seq_len:
+        raise Exception(save_file + " was built for max_seq_len=" + str(int(index['max_seq_len'])) +
+                        ", rerun build_msa_index with max_seq_len=" + str(max_seq_len))
+    pos = {f: i for i, f in enumerate(index['filenames'])}
+    missing = [f for f in filenames if f not in pos]
+    if len(missing) > 0:
+        raise Exception(str(len(missing)) + " MSAs missing from " + save_file + ", rerun build_msa_index")
+    rows = np.array([pos[f] for f in filenames], dtype=np.int64)
+    return {k: index[k][rows] for k in ['depth', 'length', 'gap_depth', 'query_idx']}
+
+
 def get_idr_query_index(data_dir, all_files, save_file):
     """
     Function to get IDR query index
@@ -257,8 +607,7 @@ class TRRMSADataset(Dataset):
         sliced_msa = msa[:, slice_start: slice_start + seq_len]
         anchor_seq = sliced_msa[0]  # This is the query sequence in MSA
 
-        sliced_msa = [list(seq) for seq in sliced_msa if (list(set(seq)) != [self.tokenizer.alphabet.index(GAP)])]
-        sliced_msa = np.asarray(sliced_msa)
+        sliced_msa = remove_gap_rows(sliced_msa, self.tokenizer.alphabet.index(GAP))
         msa_num_seqs = len(sliced_msa)
 
         # If fewer sequences in MSA than self.n_sequences, create sequences padded with PAD token based on 'random' or
@@ -274,29 +623,7 @@ class TRRMSADataset(Dataset):
             elif self.selection_type == 'non-random':
                 output = sliced_msa[:self.n_sequences]
             elif self.selection_type == "MaxHamming":
-                output = [list(anchor_seq)]
-                msa_subset = sliced_msa[1:]
-                msa_ind = np.arange(msa_num_seqs)[1:]
-                random_ind = np.random.choice(msa_ind)
-                random_seq = sliced_msa[random_ind]
-                output.append(list(random_seq))
-                random_seq = np.expand_dims(random_seq, axis=0)
-                msa_subset = np.delete(msa_subset, (random_ind - 1), axis=0)
-                m = len(msa_ind) - 1
-                distance_matrix = np.ones((self.n_sequences - 2, m))
-
-                for i in range(self.n_sequences - 2):
-                    curr_dist = cdist(random_seq, msa_subset, metric='hamming')
-                    curr_dist = np.expand_dims(np.array(curr_dist), axis=0)  # shape is now (1,msa_num_seqs)
-                    distance_matrix[i] = curr_dist
-                    col_min = np.min(distance_matrix, axis=0) # (1,num_choices)
-                    max_ind = np.argmax(col_min)
-                    random_ind = max_ind
-                    random_seq = msa_subset[random_ind]
-                    output.append(list(random_seq))
-                    random_seq = np.expand_dims(random_seq, axis=0)
-                    msa_subset = np.delete(msa_subset, random_ind, axis=0)
-                    distance_matrix = np.delete(distance_matrix, random_ind, axis=1)
+                output = subsample_max_hamming(anchor_seq, sliced_msa[1:], self.n_sequences)
         else:
             output = sliced_msa
         output = [''.join(seq) for seq in self.alpha[output]]
@@ -337,14 +664,45 @@ class A3MMSADataset(Dataset):
         else:
             raise FileNotFoundError(data_dir)
 
-        [print(f"Excluding {x}") for x in Path(self.data_dir).glob("*.npz")]
-        if Path(self.data_dir).is_dir():    
-            all_files = [x for x in Path(self.data_dir).glob("*[!.npz]")]
-            all_files = sorted(all_files)
+        if Path(self.data_dir).is_dir():
+            print("Excluding", len(list(Path(self.data_dir).glob("*.npz"))), ".npz files")
+            all_files = sorted(Path(self.data_dir).glob("*[!.npz]"))
+            cache_dir = self.data_dir
         else:
-            all_files = [self.data_dir]
+            all_files = [Path(self.data_dir)]
+            cache_dir = os.path.dirname(self.data_dir) or '.'
         print("unfiltered length", len(all_files))
         if openfold:
+            all_files = [x.name for x in all_files]
+            state = [_file_state(data_dir + f) for f in [MSA_INDEX_FILE, 'openfold_depths.npz', 'openfold_lengths.npz',
+                                                         'openfold_gap_depths.npz']]
+        else:
+            all_files = [str(x) for x in all_files]
+            state = [_file_state(f) for f in all_files] # lengths are parsed from the MSAs themselves
+        key = ('A3MMSADataset', _names_digest(all_files), state, max_seq_len, min_depth, openfold)
+        metadata = cached_metadata(cache_dir, key,
+                                   lambda: self._filter_files(data_dir, all_files, max_seq_len, min_depth, openfold))
+        self.filenames = metadata['filenames']  # IDs of samples to include
+        self.lengths = metadata['lengths'] # pass to batch sampler
+        self.depths = metadata['depths'] # rows available to subsample from
+        self.n_sequences = n_sequences
+        self.max_seq_len = max_seq_len
+        self.selection_type = selection_type
+
+    @staticmethod
+    def _filter_files(data_dir, all_files, max_seq_len, min_depth, openfold):
+        "Filter all_files by depth and gap depth, only run when the dataset cache is missing or stale"
+        all_files = np.array(all_files)
+        if openfold and os.path.exists(data_dir + MSA_INDEX_FILE):
+            index = load_msa_index(data_dir, all_files, max_seq_len)
+            keep = np.ones(len(all_files), dtype=bool)
+            if min_depth is not None: # filter out MSAs < min_depth, before and after removing high gap rows
+                keep = (index['depth'] >= min_depth) & (index['gap_depth'] >= min_depth)
+            lengths = index['length'][keep]
+            depths = index['gap_depth'][keep]
+            all_files = all_files[keep]
+            print("filter MSA depth and rows with GAPs >", max_seq_len, len(all_files))
+        elif openfold:
             ## Filter based on depth (keep > 64 seqs/MSA)
             if not os.path.exists(data_dir + 'openfold_lengths.npz'):
                 raise Exception("Missing openfold_lengths.npz in openfold/")
@@ -373,38 +731,42 @@ class A3MMSADataset(Dataset):
             gap_depths = gap_depths[gap_depths['gapdepth'] >= min_depth]
             filter_gaps_idx = gap_depths.index
             lengths = np.array(lengths)[filter_gaps_idx]
+            depths = np.array(_gap_depths)[filter_gaps_idx]
             all_files = np.array(all_files)[filter_gaps_idx]
             print("filter rows with GAPs > 512", len(all_files))
         else:
-            all_files = np.array(all_files) #maybe expand to whole path 
             lengths = []
+            depths = []
             for file in all_files:
                 parsed_msa = parse_fasta(file)
                 lengths.append(max([len(line) for line in parsed_msa]))
-        lengths = np.array(lengths)
-        self.filenames = all_files  # IDs of samples to include
-        self.lengths = lengths # pass to batch sampler
-        self.n_sequences = n_sequences
-        self.max_seq_len = max_seq_len
-        self.selection_type = selection_type
+                depths.append(len(parsed_msa))
+        return {'filenames': np.array(all_files), 'lengths': np.array(lengths), 'depths': np.array(depths)}
 
     def __len__(self):
         return len(self.filenames)
 
-    def __getitem__(self, idx):
+    stream_random = True # read 'random' selections with read_a3m_random
+
+    def _path(self, idx):
         filename = self.filenames[idx]
         if self.openfold:
-            path = read_openfold_files(self.data_dir, filename)
-        else:
-            path = filename
-        parsed_msa = parse_fasta(path)
+            return read_openfold_files(self.data_dir, filename)
+        return filename
 
-        aligned_msa = [[char for char in seq if (char.isupper() or char == '-') and not char == '.'] for seq in parsed_msa]
-        aligned_msa = [''.join(seq) for seq in aligned_msa]
+    def _read(self, idx):
+        "Tokenized (N, L) MSA at idx, query sequence in the first row"
+        return read_a3m(self._path(idx), self.tokenizer)
 
-        tokenized_msa = [self.tokenizer.tokenizeMSA(seq) for seq in aligned_msa]
-        tokenized_msa = np.array([l.tolist() for l in tokenized_msa])
-        msa_seq_len = len(tokenized_msa[0])
+    def __getitem__(self, idx):
+        if self.selection_type == 'random' and self.stream_random:
+            output, msa_num_seqs = read_a3m_random(self._path(idx), self.tokenizer, self.n_sequences,
+                                                   self.max_seq_len)
+            if msa_num_seqs < self.n_sequences:
+                raise Exception("msa num_seqs < self.n_sequences, indicates dataset not filtered properly")
+            return [''.join(seq) for seq in self.alpha[output]]
+        tokenized_msa = self._read(idx)
+        msa_seq_len = tokenized_msa.shape[1]
 
         if msa_seq_len > self.max_seq_len:
             slice_start = np.random.choice(msa_seq_len - self.max_seq_len + 1)
@@ -418,7 +780,7 @@ class A3MMSADataset(Dataset):
         anchor_seq = sliced_msa_seq[0]  # This is the query sequence in MSA
 
         # slice out all-gap rows
-        sliced_msa = [seq for seq in sliced_msa_seq if (list(set(seq)) != [self.gap_idx])]
+        sliced_msa = remove_gap_rows(sliced_msa_seq, self.gap_idx)
         msa_num_seqs = len(sliced_msa)
 
         if msa_num_seqs < self.n_sequences:
@@ -441,29 +803,7 @@ class A3MMSADataset(Dataset):
                 anchor_seq = np.expand_dims(anchor_seq, axis=0)
                 output = np.concatenate((anchor_seq, np.array(sliced_msa)[random_idx.astype(int)]), axis=0)
             elif self.selection_type == "MaxHamming":
-                output = [list(anchor_seq)]
-                msa_subset = sliced_msa[1:]
-                msa_ind = np.arange(msa_num_seqs)[1:]
-                random_ind = np.random.choice(msa_ind)
-                random_seq = sliced_msa[random_ind]
-                output.append(list(random_seq))
-                random_seq = np.expand_dims(random_seq, axis=0)
-                msa_subset = np.delete(msa_subset, (random_ind - 1), axis=0)
-                m = len(msa_ind) - 1
-                distance_matrix = np.ones((self.n_sequences - 2, m))
-
-                for i in range(self.n_sequences - 2):
-                    curr_dist = cdist(random_seq, msa_subset, metric='hamming')
-                    curr_dist = np.expand_dims(np.array(curr_dist), axis=0)  # shape is now (1,msa_num_seqs)
-                    distance_matrix[i] = curr_dist
-                    col_min = np.min(distance_matrix, axis=0)  # (1,num_choices)
-                    max_ind = np.argmax(col_min)
-                    random_ind = max_ind
-                    random_seq = msa_subset[random_ind]
-                    output.append(list(random_seq))
-                    random_seq = np.expand_dims(random_seq, axis=0)
-                    msa_subset = np.delete(msa_subset, random_ind, axis=0)
-                    distance_matrix = np.delete(distance_matrix, random_ind, axis=1)
+                output = subsample_max_hamming(anchor_seq, sliced_msa[1:], self.n_sequences)
         else:
             output = sliced_msa
 
@@ -471,6 +811,73 @@ class A3MMSADataset(Dataset):
         return output
 
 
+class MSAShardDataset(A3MMSADataset):
+    """Build dataset from MSA shards written by write_msa_shards: MSA Absorbing Diffusion model"""
+
+    stream_random = False # rows are already tokenized in the shards
+
+    def __init__(self, selection_type, n_sequences, max_seq_len, data_dir=None, min_depth=None):
+        """
+        Args:
+            selection_type: str,
+                MSA selection strategy of random or MaxHamming
+            n_sequences: int,
+                number of sequences to subsample down to
+            max_seq_len: int,
+                maximum MSA sequence length
+            data_dir: str,
+                directory with msa_shard_<k>.bin files and msa_shards_index.npz
+            min_depth: int,
+                filter out shallower MSAs
+        """
+        alphabet = PROTEIN_ALPHABET
+        self.tokenizer = Tokenizer(alphabet)
+        self.alpha = np.array(list(alphabet))
+        self.gap_idx = self.tokenizer.alphabet.index(GAP)
+        self.openfold = False
+
+        if data_dir is not None:
+            self.data_dir = data_dir
+        else:
+            raise FileNotFoundError(data_dir)
+        index = np.load(os.path.join(self.data_dir, 'msa_shards_index.npz'))
+        if str(index['alphabet']) != alphabet:
+            raise Exception("MSA shards in " + self.data_dir + " were written with a different alphabet")
+        if 'gap_depth' not in index.files:
+            raise Exception("MSA shards in " + self.data_dir + " have no gap depth, rerun write_msa_shards")
+        if int(index['max_seq_len']) != max_seq_len:
+            raise Exception("MSA shards in " + self.data_dir + " were written for max_seq_len=" +
+                            str(int(index['max_seq_len'])) + ", rerun write_msa_shards with max_seq_len=" +
+                            str(max_seq_len))
+        keep = np.ones(len(index['depth']), dtype=bool)
+        if min_depth is not None: # filter out MSAs < min_depth, before and after removing high gap rows
+            keep = (index['depth'] >= min_depth) & (index['gap_depth'] >= min_depth)
+        self.filenames = index['filenames'][keep]
+        self.lengths = index['length'][keep] # pass to batch sampler
+        self.depths = index['gap_depth'][keep] # rows available to subsample from
+        self.rows = index['depth'][keep] # rows stored in the shard
+        self.shards = index['shard'][keep]
+        self.offsets = index['offset'][keep]
+        self.query_idxs = index['query_idx'][keep]
+        self.n_sequences = n_sequences
+        self.max_seq_len = max_seq_len
+        self.selection_type = selection_type
+        self._memmaps = {} # opened lazily, once per process
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_memmaps'] = {}
+        return state
+
+    def _read(self, idx):
+        shard = self.shards[idx]
+        if shard not in self._memmaps:
+            self._memmaps[shard] = np.memmap(os.path.join(self.data_dir, 'msa_shard_%d.bin' % shard),
+                                             dtype=np.uint8, mode='r')
+        depth, length, offset = self.rows[idx], self.lengths[idx], self.offsets[idx]
+        return self._memmaps[shard][offset: offset + depth * length].reshape(depth, length)
+
+
 class IDRDataset(Dataset):
     """Build dataset for IDRs"""
 
@@ -497,11 +904,37 @@ class IDRDataset(Dataset):
         else:
             raise FileNotFoundError(data_dir)
 
-        [print("Excluding", x) for x in os.listdir(self.data_dir) if x.endswith('.npz')]
-        all_files = [x for x in os.listdir(self.data_dir) if not x.endswith('.npz')]
-        all_files = sorted(all_files)
+        names = os.listdir(self.data_dir)
+        all_files = sorted(x for x in names if not x.endswith('.npz'))
+        print("Excluding", len(names) - len(all_files), ".npz files")
         print("unfiltered length", len(all_files))
+        if min_depth is not None: # reindex, filtering out MSAs < min_depth
+            raise Exception("MIN DEPTH CONSTRAINT NOT CURRENTLY WORKING ON IDRS")
 
+        state = [_file_state(data_dir + f) for f in [MSA_INDEX_FILE, 'idr_depths.npz', 'idr_lengths.npz',
+                                                     'idr_query_idxs.npz']]
+        key = ('IDRDataset', _names_digest(all_files), state, max_seq_len)
+        metadata = cached_metadata(self.data_dir, key, lambda: self._filter_files(data_dir, all_files, max_seq_len))
+        self.filenames = metadata['filenames']  # IDs of samples to include
+        self.lengths = metadata['lengths'] # pass to batch sampler
+        self.n_sequences = n_sequences
+        self.max_seq_len = max_seq_len
+        self.selection_type = selection_type
+        self.query_idxs = metadata['query_idxs']
+
+    @staticmethod
+    def _filter_files(data_dir, all_files, max_seq_len):
+        "Filter all_files by length, only run when the dataset cache is missing or stale"
+        if os.path.exists(data_dir + MSA_INDEX_FILE): # written by build_msa_index(..., idr=True)
+            index = load_msa_index(data_dir, all_files, None) # gap depth is not used for IDRs
+            if (index['query_idx'] < 0).any():
+                raise Exception("Query sequence not found in " + str((index['query_idx'] < 0).sum()) + " MSAs")
+            keep = np.ones(len(all_files), dtype=bool)
+            if max_seq_len is not None:
+                keep = index['length'] <= max_seq_len
+            all_files = np.array(all_files)[keep]
+            print("filter MSA length >", max_seq_len, len(all_files))
+            return {'filenames': all_files, 'lengths': index['length'][keep], 'query_idxs': index['query_idx'][keep]}
         ## Filter based on depth (keep > 64 seqs/MSA)
         if not os.path.exists(data_dir + 'idr_lengths.npz'):
             raise Exception("Missing idr_lengths.npz in human_idr_alignments/human_protein_alignments/")
@@ -511,8 +944,7 @@ class IDRDataset(Dataset):
         _depths = np.load(data_dir + 'idr_depths.npz')['arr_0']
         depths = pd.DataFrame(_depths, columns=['depth'])
 
-        if min_depth is not None: # reindex, filtering out MSAs < min_depth
-            raise Exception("MIN DEPTH CONSTRAINT NOT CURRENTLY WORKING ON IDRS")
+        #if min_depth is not None:
         #    depths = depths[depths['depth'] >= min_depth]
         #keep_idx = depths.index
 
@@ -529,12 +961,7 @@ class IDRDataset(Dataset):
         _query_idxs = np.load(data_dir+'idr_query_idxs.npz')['arr_0']
         query_idxs = np.array(_query_idxs)[keep_idx]
 
-        self.filenames = all_files  # IDs of samples to include
-        self.lengths = lengths # pass to batch sampler
-        self.n_sequences = n_sequences
-        self.max_seq_len = max_seq_len
-        self.selection_type = selection_type
-        self.query_idxs = query_idxs
+        return {'filenames': all_files, 'lengths': lengths, 'query_idxs': query_idxs}
 
 
     def __len__(self):
@@ -543,14 +970,12 @@ class IDRDataset(Dataset):
     def __getitem__(self, idx):
         filename = self.filenames[idx]
         path = read_idr_files(self.data_dir, filename)
-        parsed_msa = parse_fasta(path)
-        aligned_msa = [[char for char in seq if (char.isupper() or char == '-') and not char == '.'] for seq in parsed_msa]
-        aligned_msa = [''.join(seq) for seq in aligned_msa]
-
-        tokenized_msa = [self.tokenizer.tokenizeMSA(seq) for seq in aligned_msa]
-
-        tokenized_msa = np.array([l.tolist() for l in tokenized_msa])
-        msa_seq_len = len(tokenized_msa[0])
+        if self.selection_type == 'random':
+            output, _ = read_a3m_random(path, self.tokenizer, self.n_sequences, self.max_seq_len,
+                                        query_idx=self.query_idxs[idx])
+            return [''.join(seq) for seq in self.alpha[output]]
+        tokenized_msa = read_a3m(path, self.tokenizer)
+        msa_seq_len = tokenized_msa.shape[1]
         print("msa_seq_len", msa_seq_len, "max seq len", self.max_seq_len)
 
         if msa_seq_len > self.max_seq_len:
@@ -570,7 +995,7 @@ class IDRDataset(Dataset):
         #del tokenized_msa[query_idx]
 
         # slice out all-gap rows
-        sliced_msa = [seq for seq in sliced_msa_seq if (list(set(seq)) != [self.gap_idx])]
+        sliced_msa = remove_gap_rows(sliced_msa_seq, self.gap_idx)
         msa_num_seqs = len(sliced_msa)
 
         # if msa_num_seqs < self.n_sequences:
@@ -581,29 +1006,7 @@ class IDRDataset(Dataset):
                 anchor_seq = np.expand_dims(anchor_seq, axis=0)
                 output = np.concatenate((anchor_seq, np.array(sliced_msa)[random_idx.astype(int)]), axis=0)
             elif self.selection_type == "MaxHamming":
-                output = [list(anchor_seq)]
-                msa_subset = sliced_msa[1:]
-                msa_ind = np.arange(msa_num_seqs)[1:]
-                random_ind = np.random.choice(msa_ind)
-                random_seq = sliced_msa[random_ind]
-                output.append(list(random_seq))
-                random_seq = np.expand_dims(random_seq, axis=0)
-                msa_subset = np.delete(msa_subset, (random_ind - 1), axis=0)
-                m = len(msa_ind) - 1
-                distance_matrix = np.ones((self.n_sequences - 2, m))
-
-                for i in range(self.n_sequences - 2):
-                    curr_dist = cdist(random_seq, msa_subset, metric='hamming')
-                    curr_dist = np.expand_dims(np.array(curr_dist), axis=0)  # shape is now (1,msa_num_seqs)
-                    distance_matrix[i] = curr_dist
-                    col_min = np.min(distance_matrix, axis=0)  # (1,num_choices)
-                    max_ind = np.argmax(col_min)
-                    random_ind = max_ind
-                    random_seq = msa_subset[random_ind]
-                    output.append(list(random_seq))
-                    random_seq = np.expand_dims(random_seq, axis=0)
-                    msa_subset = np.delete(msa_subset, random_ind, axis=0)
-                    distance_matrix = np.delete(distance_matrix, random_ind, axis=1)
+                output = subsample_max_hamming(anchor_seq, sliced_msa[1:], self.n_sequences)
         else:
             output = sliced_msa
 
@@ -4,7 +4,7 @@ import torch
 import os
 import glob
 import random
-from evodiff.utils import Tokenizer
+from evodiff.utils import Tokenizer, log_transition, log_p_theta_marg
 import pathlib
 from sequence_models.datasets import UniRefDataset
 from tqdm import tqdm
@@ -266,8 +266,8 @@ def generate_d3pm(model, tokenizer, Q, Q_bar, timesteps, seq_len, batch_size=3,
     sample = torch.randint(0, tokenizer.K, (batch_size, seq_len))
     sample = sample.to(torch.long)
     sample = sample.to(device)
-    Q = Q.to(device)
-    Q_bar = Q_bar.to(device)
+    log_Q = log_transition(Q.to(device)) # log-space posterior is stable in float32
+    log_Q_bar = log_transition(Q_bar.to(device))
 
     timesteps = torch.linspace(timesteps-1,1,int((timesteps-1)/1), dtype=int) # iterate over reverse timesteps
     timesteps = timesteps.to(device)
@@ -277,24 +277,17 @@ def generate_d3pm(model, tokenizer, Q, Q_bar, timesteps, seq_len, batch_size=3,
             timesteps = timesteps.to(device)
             prediction = model(sample, timesteps)
             p = prediction[:, :, :tokenizer.K]  # p_theta_tilde (x_0_tilde | x_t) # Don't predict non-standard AAs
-            p = torch.nn.functional.softmax(p, dim=-1)  # softmax over categorical probs
-            p = p.to(torch.float64)
-            x_tminus1 = sample.clone()
-            for i, s in enumerate(sample):
-                x_t_b = tokenizer.one_hot(s)
-                A = torch.mm(x_t_b, torch.t(Q[t]))  # [P x K]
-                Q_expand = Q_bar[t-1].unsqueeze(0).expand(A.shape[0], tokenizer.K, tokenizer.K)  # [ P x K x K]
-                B_pred = torch.mul(p[i].unsqueeze(2), Q_expand)
-                q_t = torch.mul(A.unsqueeze(1), B_pred)  # [ P x K x K ]
-                p_theta_marg = torch.bmm(torch.transpose(q_t, 1,2),  p[i].unsqueeze(2)).squeeze()  # this marginalizes over dim=2
-                p_theta_marg = p_theta_marg / p_theta_marg.sum(axis=1, keepdim=True)
-                x_tminus1[i] = torch.multinomial(p_theta_marg, num_samples=1).squeeze()
-                # On final timestep pick next best from standard AA
-                if t == 1:
-                     x_tminus1[i] = torch.multinomial(p_theta_marg[:, :tokenizer.K-6], num_samples=1).squeeze()
-                # diff = torch.ne(s, x_tminus1[i])
-                # if t % 100 == 0:
-                #     print("time", t, diff.sum().item(), "mutations", tokenizer.untokenize(x_tminus1[i]), "sample", tokenizer.untokenize(s))
+            log_p = torch.nn.functional.log_softmax(p.float(), dim=-1)  # softmax over categorical probs
+            log_A = log_Q[t].t()[sample]  # [B x P x K], x_t Q[t]^T
+            log_p_marg = log_p_theta_marg(log_p, log_A, log_Q_bar[t-1])  # marginalizes over dim=2, whole batch at once
+            # On final timestep pick next best from standard AA
+            if t == 1:
+                log_p_marg = log_p_marg[:, :, :tokenizer.K-6]
+            p_theta_marg = log_p_marg.exp().flatten(start_dim=0, end_dim=1)
+            x_tminus1 = torch.multinomial(p_theta_marg, num_samples=1).reshape(sample.shape)
+            # diff = torch.ne(sample, x_tminus1)
+            # if t % 100 == 0:
+            #     print("time", t, diff.sum().item(), "mutations", tokenizer.untokenize(x_tminus1[0]), "sample", tokenizer.untokenize(sample[0]))
             sample = x_tminus1
 
     untokenized = [tokenizer.untokenize(s) for s in sample]
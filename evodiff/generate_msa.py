@@ -12,7 +12,7 @@ import torch
 from sequence_models.collaters import MSAAbsorbingCollater
 from evodiff.collaters import D3PMCollaterMSA
 from sequence_models.constants import MSA_ALPHABET
-from evodiff.utils import Tokenizer
+from evodiff.utils import Tokenizer, log_transition, log_p_theta_marg
 home = str(pathlib.Path.home())
 
 def main():
@@ -36,6 +36,7 @@ def main():
     parser.add_argument('--start-query', action='store_true') # if starting from query -> gen msa
     parser.add_argument('--start-msa', action='store_true') # if starting from msa -> gen query
     parser.add_argument('--amlt', action='store_true') # if running on amlt
+    parser.add_argument('--attention-budget', type=int, default=None) # max bytes per attention block (D3PM models)
     args = parser.parse_args()
 
     #_ = torch.manual_seed(0)
@@ -105,6 +106,8 @@ def main():
         model, collater, tokenizer, scheme = checkpoint
 
     model = model.eval().to(device)
+    if args.attention_budget is not None:
+        model.attention_budget = args.attention_budget # chunked row/column attention in MSATransformerTime
 
     #project_dir = home + '/Desktop/DMs/'
 
@@ -293,6 +296,8 @@ def generate_msa_d3pm(model, batch_size, n_sequences, seq_length, Q_bar=None, Q=
         timesteps = np.linspace(max_timesteps-1, max_timesteps-1, 1, dtype=int)
     else:
         timesteps = np.linspace(max_timesteps-1,1,int((max_timesteps-1)/1), dtype=int) # iterate over reverse timesteps
+    log_Q = log_transition(Q.to(device)) # log-space posterior is stable in float32
+    log_Q_bar = log_transition(Q_bar.to(device))
     with torch.no_grad():
         print(timesteps[-1])
         for t in tqdm(timesteps):
@@ -300,28 +305,20 @@ def generate_msa_d3pm(model, batch_size, n_sequences, seq_length, Q_bar=None, Q=
             timesteps = timesteps.to(device)
             prediction = model(sample, timesteps)
             p = prediction[:, :, :, :tokenizer.K]  # p_theta_tilde (x_0_tilde | x_t)
-            p = torch.nn.functional.softmax(p, dim=-1)  # softmax over categorical probs
-            p = p.to(torch.float64)
+            log_p = torch.nn.functional.log_softmax(p.float(), dim=-1)  # softmax over categorical probs
             x_tminus1 = sample.clone()
             for i, s in enumerate(sample): # iterate over batches
                 # Calculate p_theta_marg from p_theta_tilde
                 # FIRST UNPAD sample in batch
                 if start_query:
                     s = s[:, :len(y_indices[i])]
-                    p_current = p[i, :, :len(y_indices[i])].flatten(start_dim=0, end_dim=1)
+                    log_p_current = log_p[i, :, :len(y_indices[i])].flatten(start_dim=0, end_dim=1)
                 else:
-                    p_current = p[i].flatten(start_dim=0, end_dim=1)
-                x_t_b = torch.stack([tokenizer.one_hot(s_i) for s_i in s])
-                x_t_b = x_t_b.flatten(start_dim=0, end_dim=1)
-                A = torch.mm(x_t_b, torch.t(Q[t]))  # [P x K]
-                Q_expand = Q_bar[t-1].unsqueeze(0).expand(A.shape[0], tokenizer.K, tokenizer.K)  # [ P x K x K]
-                B_pred = torch.mul(p_current.unsqueeze(2), Q_expand)
-                q_t = torch.mul(A.unsqueeze(1), B_pred)  # [ P x K x K ]
-                p_theta_marg = torch.bmm(torch.transpose(q_t, 1,2),  p_current.unsqueeze(2)).squeeze()  # this marginalizes over dim=2
-                p_theta_marg = p_theta_marg / p_theta_marg.sum(axis=1, keepdim=True)
-                penalty = torch.ones(p_theta_marg.shape).to(p_theta_marg.device)
-                penalty[:, -1] += penalty_value
-                p_theta_marg /= penalty
+                    log_p_current = log_p[i].flatten(start_dim=0, end_dim=1)
+                log_A = log_Q[t].t()[s.flatten()]  # [P x K], x_t Q[t]^T
+                log_p_marg = log_p_theta_marg(log_p_current, log_A, log_Q_bar[t-1])  # this marginalizes over dim=2
+                log_p_marg[:, -1] -= np.log1p(penalty_value) # penalize gaps
+                p_theta_marg = log_p_marg.exp()
                 x_tminus1_temp = torch.multinomial(p_theta_marg[:, :], num_samples=1).squeeze()
                 x_tminus1_temp[:seq_length] = torch.multinomial(p_theta_marg[:seq_length,:-1], num_samples=1).squeeze() # NO GAPS in query
                 if start_query:
@@ -1,8 +1,27 @@
+import functools
 import torch
 from torch.nn import CrossEntropyLoss, KLDivLoss
-from evodiff.utils import Tokenizer
+from torch.utils.checkpoint import checkpoint
+from evodiff.utils import Tokenizer, log_transition, log_p_theta_marg
 from sequence_models.constants import MSA_AAS
 
+def fp32_island(forward):
+    "Runs a loss forward with autocast off, so callers that autocast the model don't drop the loss math to 16 bits"
+    @functools.wraps(forward)
+    def wrapper(*args, **kwargs):
+        with torch.autocast('cuda', enabled=False), torch.autocast('cpu', enabled=False):
+            return forward(*args, **kwargs)
+    return wrapper
+
+def _token_ids(tokens, dim, K):
+    """
+    Token ids of tokens given as ids with dim dims, or as one hots with an extra last dim (compatibility). Ids >= K
+    (padding, specials) map to 0, the argmax of their all zero one hot rows
+    """
+    if tokens.dim() > dim:
+        return tokens[..., :K].argmax(-1)
+    return torch.where(tokens < K, tokens, 0)
+
 def sample_prior(a,b, _len=len(MSA_AAS)):
     """
     Returns prior for KL at T-> inf with same shape as q over total possible values (all_aas)
@@ -43,7 +62,9 @@ class OAMaskedCrossEntropyLoss(CrossEntropyLoss):
         self.reweight=reweight
         self.tokenizer = tokenizer
         super().__init__(weight=weight, reduction=reduction)
+    @fp32_island
     def forward(self, pred, tgt, mask, timesteps, input_mask):
+        pred = pred.to(torch.promote_types(pred.dtype, torch.float32))
         # Make sure we have that empty last dimension
         if len(mask.shape) == len(pred.shape) - 1:
             mask = mask.unsqueeze(-1)
@@ -85,7 +106,9 @@ class D3PMCELoss(CrossEntropyLoss):
         self.tokenizer = tokenizer
         self.sequences=sequences
         super().__init__(weight=weight, reduction=reduction)
+    @fp32_island
     def forward(self, pred, tgt, input_mask):
+        pred = pred.to(torch.promote_types(pred.dtype, torch.float32))
         if self.sequences:
             p = pred[:, :, :self.tokenizer.K]
         else: # MSAs
@@ -101,11 +124,11 @@ class D3PMLVBLoss(KLDivLoss):
     """
     Shape:
         Inputs:
-            - src_one_hot: (B, L, K) original seq one hot encoded
+            - src: (B, L) noised seq tokenized, or (B, L, K) one hot encoded
             - q: (B, L, K) forward prob dist
             - predictions: (B, L, K) model predictions
-            - tgt: (B, L) corrupted MSA tokenized
-            - tgt_one_hot: (B, L, K) corrupted MSA one hot encoded
+            - tgt: (B, L) original seq tokenized
+            - tgt_one_hot: unused, tgt holds the same tokens (may be None)
             - input_mask: (B, L) bool mask indicating pad locations
             - timestep (B)
             - Q (K, K) transition matrix
@@ -113,6 +136,7 @@ class D3PMLVBLoss(KLDivLoss):
 
         Returns
             - lvb: lower var bound loss as defined in Structured Denoising Diffusion, Austin et. al
+              with reduction='none' the (B,) per sequence terms, e.g. to reweight for importance sampled timesteps
     """
     def __init__(self, tmax=500, reduction='batchmean', log_target=False, tokenizer=Tokenizer()):
         self.tmax = tmax
@@ -121,86 +145,98 @@ class D3PMLVBLoss(KLDivLoss):
         super().__init__(reduction=reduction, log_target=log_target)
         self.reconstruction_loss = D3PMCELoss(tokenizer=self.tokenizer)
 
-    def forward(self, src_onehot, q, predictions, tgt, tgt_onehot, input_mask, timestep, Q, Q_bar):
-        p = torch.nn.functional.softmax(predictions[:, :, :self.K], dim=2) # ignoring specials
-        losses = []
-        nonpad_loc = input_mask.sum(axis=1)
-        for i in range(tgt.shape[0]): # enumerate over batch
-            D = int(nonpad_loc[i].item())  # want prior/q in shape of seq len (q has shape of longest seq in batch)
-            if timestep[i] == 1:
-                # CE (L_t=0)
-                #reconstruction_loss = D3PMCELoss(tokenizer=self.tokenizer)
-                r_loss = self.reconstruction_loss(predictions[i].unsqueeze(0), tgt[i].unsqueeze(0), input_mask[i].unsqueeze(0))
-                losses.append(r_loss)
-            elif timestep[i] == self.tmax: # Not needed to compute gradients
-                # D KL (L_T)
-                # As T approches infinity, this term goes to zero
-                q_true = q[i, :D]
-                prior = sample_prior(q_true.shape[0], q_true.shape[1], _len=self.K)
-                prior = prior.to(tgt.device)
-                kl_loss_i = super().forward(prior.log(), q_true)  # fKLDivLoss expects input in log-space
-                #print("KL SHOULD BE ~ZERO", kl_loss_i)
-                losses.append(kl_loss_i)
-            else:
-                # D KL (L_t-1) -> (q(x|x_t, x_0), p_theta)
-                pred = p[i, :D]
-                pred = pred.to(torch.float64)
-                x_t = src_onehot[i,:D]
-                x_0 = tgt_onehot[i,:D]
-
-                # Calculate p_theta_marg, simplified for loops
-                A = torch.mm(x_t, torch.t(Q[timestep[i]]))  # [P x K]
-                #A_expand = A.unsqueeze(1).expand(A.shape[0], self.K, self.K)  # [P x K x K] # this is the same as A.unsqueeze(1), B_expand)
-                B = torch.mm(x_0, Q_bar[timestep[i] - 1]) # P x K
-                Q_expand = Q_bar[timestep[i] - 1].unsqueeze(0).expand(A.shape[0], self.K, self.K)  # [ P x K x K]
-                B_pred = torch.mul(pred.unsqueeze(2), Q_expand)
-
-                q_t = torch.mul(A.unsqueeze(1), B_pred)
-                p_theta_marg = torch.bmm(torch.transpose(q_t, 1,2), pred.unsqueeze(2)).squeeze() # mul and sum over model logits
-
-                # calculate q_t_minus_1, simplified for loops
-                num = torch.mul(A, B)
-                denom = torch.bmm(torch.mm(x_0, Q_bar[timestep[i]]).unsqueeze(1), x_t.unsqueeze(2))
-                q_t_minus1 = num / denom.squeeze().unsqueeze(1)
-
-                p_theta_marg = p_theta_marg / p_theta_marg.sum(axis=1, keepdim=True)  # re-normalize probs per residue
-                p_theta_marg = p_theta_marg.to(tgt.device)
-                kl_loss_i = super().forward(p_theta_marg.log(), q_t_minus1)  # KLDivLoss expects input in log-space
-                losses.append(kl_loss_i)
-                #print("kl loss", kl_loss_i.dtype)
-
-        losses = torch.stack(losses) # loss per sequence in batch
+    @fp32_island
+    def forward(self, src, q, predictions, tgt, tgt_onehot, input_mask, timestep, Q, Q_bar):
+        dtype = torch.promote_types(predictions.dtype, torch.float32) # log-space posterior is stable in float32
+        nonpad_loc = input_mask.bool()
+        D = nonpad_loc.sum(axis=1)  # want prior/q in shape of seq len (q has shape of longest seq in batch)
+        losses = torch.zeros(tgt.shape[0], dtype=dtype, device=tgt.device)
+        # All terms are means over the non-pad positions of each sequence, computed for the whole batch at once
+        first = timestep == 1
+        if first.any():
+            # CE (L_t=0)
+            ce = torch.nn.functional.cross_entropy(predictions[first, :, :self.K].transpose(1, 2),
+                                                   tgt[first].clamp(max=self.K - 1), reduction='none')
+            losses[first] = ((ce * nonpad_loc[first]).sum(1) / D[first]).to(dtype)
+        last = timestep == self.tmax # Not needed to compute gradients
+        if last.any():
+            # D KL (L_T)
+            # As T approches infinity, this term goes to zero
+            q_true = q[last, :, :self.K]
+            prior = sample_prior(q_true.shape[1], q_true.shape[2], _len=self.K).to(q_true)
+            kl = torch.nn.functional.kl_div(prior.log().expand_as(q_true), q_true, reduction='none').sum(2)
+            losses[last] = ((kl * nonpad_loc[last]).sum(1) / D[last]).to(dtype)
+        mid = ~(first | last)
+        if mid.any():
+            # D KL (L_t-1) -> (q(x|x_t, x_0), p_theta), in log space with one hots replaced by gathers of log Q tables
+            t = timestep[mid]
+            log_pred = torch.nn.functional.log_softmax(predictions[mid, :, :self.K].to(dtype), dim=2) # ignoring specials
+            x_t = _token_ids(src[mid], 2, self.K) # pad positions are masked below
+            x_0 = _token_ids(tgt[mid], 2, self.K)
+            batch = torch.arange(len(t), device=t.device).unsqueeze(1)
+            log_Q_bar_prev = log_transition(Q_bar[t - 1], dtype)
+            log_A = log_transition(Q[t], dtype).transpose(1, 2)[batch, x_t] # [B x P x K], x_t Q[t]^T
+            log_B = log_Q_bar_prev[batch, x_0] # [B x P x K], x_0 Q_bar[t-1]
+            # Same as sum_j A * pred_j * Q_bar[t-1][j] * pred_j in the per-sequence loss, re-normalized per residue
+            log_p_marg = log_p_theta_marg(log_pred, log_A, log_Q_bar_prev)
+            # calculate q_t_minus_1
+            log_denom = log_transition(Q_bar[t][batch, x_0, x_t], dtype) # x_0 Q_bar[t] x_t
+            log_q_t_minus1 = log_A + log_B - log_denom.unsqueeze(2)
+            kl = torch.nn.functional.kl_div(log_p_marg, log_q_t_minus1, reduction='none', log_target=True).sum(2)
+            losses[mid] = (kl * nonpad_loc[mid]).sum(1) / D[mid]
+        if self.reduction == 'none':
+            return losses
         lvb = ((losses.sum()) / (tgt.shape[0]))  # loss per batch, norm by batchsize
         return lvb
 
 
+def _posterior_kl_sum(log_pred, x_t, x_0, log_Q_t, log_Q_bar_prev):
+    """
+    Summed KL(q(x_t-1|x_t, x_0) || p_theta_marg) over positions of one MSA, in log space
+    (the MSA loss normalizes q with Q_bar[t-1])
+        log_pred: [P x K] model log probabilities
+        x_t, x_0: [P] token ids
+        log_Q_t, log_Q_bar_prev: log Q[t], log Q_bar[t-1]
+    """
+    log_A = log_Q_t.t()[x_t] # [P x K], x_t Q[t]^T
+    log_B = log_Q_bar_prev[x_0] # [P x K], x_0 Q_bar[t-1]
+    log_p_marg = log_p_theta_marg(log_pred, log_A, log_Q_bar_prev) # marginalizes over logits, renormalized per position
+    log_q_t_minus1 = log_A + log_B - log_Q_bar_prev[x_0, x_t].unsqueeze(1)
+    return torch.nn.functional.kl_div(log_p_marg, log_q_t_minus1, reduction='sum', log_target=True)
+
 
 class D3PMLVBLossMSA(KLDivLoss):
     """
         Shape:
             Inputs:
-                - src_one_hot: (B, D, L, K) original MSA one hot encoded
+                - src: (B, D, L) noised MSA tokenized, or (B, D, L, K) one hot encoded
                 - q: (B, D, L, K) forward prob dist
                 - predictions: (B, D, L, K) model predictions
-                - tgt: (B, D, L) corrupted MSA tokenized
-                - tgt_one_hot: (B, D, L, K) corrupted MSA one hot encoded
+                - tgt: (B, D, L) original MSA tokenized
+                - tgt_one_hot: unused, tgt holds the same tokens (may be None)
                 - input_mask: (B, D, L) bool mask indicating pad locations
                 - timestep (B)
                 - Q (K, K) transition matrix
                 - Q_bar (K, K) transition matrix accounting for time
+            budget: approximate bytes of temporaries per chunk of positions in the L_t-1 term
 
             Returns
                 - lower var bound loss as defined in Structured Denoising Diffusion, Austin et. al
+                  with reduction='none' the (B,) per MSA terms, e.g. to reweight for importance sampled timesteps
         """
-    def __init__(self, tmax=500, reduction='batchmean', log_target=False, tokenizer=Tokenizer()):
+    def __init__(self, tmax=500, reduction='batchmean', log_target=False, tokenizer=Tokenizer(), budget=2**26):
         self.tmax = tmax
         self.tokenizer = tokenizer
         self.K = tokenizer.K
+        # Positions per chunk of the L_t-1 term, so its float32 temporaries stay within budget bytes
+        self.chunk_size = max(1, budget // (8 * self.K * 4))
         super().__init__(reduction=reduction, log_target=log_target)
         self.reconstruction_loss = D3PMCELoss(tokenizer=self.tokenizer, sequences=False)
 
-    def forward(self, src_one_hot, q, predictions, tgt, tgt_one_hot, input_mask, timestep, Q, Q_bar):
-        p = torch.nn.functional.softmax(predictions[:, :, :, :self.K], dim=3)  # ignoring specials
+    @fp32_island
+    def forward(self, src, q, predictions, tgt, tgt_one_hot, input_mask, timestep, Q, Q_bar):
+        dtype = torch.promote_types(predictions.dtype, torch.float32) # log-space posterior is stable in float32
+        log_p = torch.nn.functional.log_softmax(predictions[:, :, :, :self.K].to(dtype), dim=3)  # ignoring specials
         losses = []
         nonpad_loc = input_mask.sum(axis=2)
         for i in range(len(tgt)): # enumerate over batch
@@ -215,35 +251,34 @@ class D3PMLVBLossMSA(KLDivLoss):
                 # As T approches infinity, this term goes to zero
                 q_true = q[i, :, :D, :]
                 prior = sample_priorMSA(q_true.shape[0], q_true.shape[1], q_true.shape[2], _len=self.tokenizer.alphabet)
-                prior = prior.to(tgt.device)
-                kl_loss_i = super().forward(prior.log(), q_true)  # fKLDivLoss expects input in log-space
+                prior = prior.to(q_true)
+                # KL summed over tokens and averaged over positions, a per MSA scalar like the other terms
+                kl = torch.nn.functional.kl_div(prior.log(), q_true, reduction='none').sum(-1)
+                kl_loss_i = kl.mean().to(dtype)
                 losses.append(kl_loss_i)
                 #print(timestep[i], kl_loss_i)
             else:
                 # D KL (L_t-1) -> (q(x|x_t, x_0), p_theta_marg)
-                pred = p[i, :, :D, :self.K].flatten(start_dim=0, end_dim=1) # [pos x tokens]
-                pred = pred.to(torch.float64)  # must use 64 not 32 or p_theta_marg
-                x_t = src_one_hot[i, :, :D, :self.K].flatten(start_dim=0, end_dim=1)
-                x_0 = tgt_one_hot[i, :, :D, :self.K].flatten(start_dim=0, end_dim=1)
-
-                # Calculate p_theta_marg, simplified for loops
-                A = torch.mm(x_t, torch.t(Q[timestep[i]]))  # [P x K]
-                B = torch.mm(x_0, Q_bar[timestep[i] - 1])  # P x K
-                Q_expand = Q_bar[timestep[i] - 1].unsqueeze(0).expand(A.shape[0], self.K, self.K)  # [ P x K x K]
-                B_pred = torch.mul(pred.unsqueeze(2), Q_expand)
-                q_t = torch.mul(A.unsqueeze(1), B_pred)  # batch mul (broadcast logit dim)
-                p_theta_marg = torch.bmm(torch.transpose(q_t, 1,2), pred.unsqueeze(2)).squeeze() # this marginalizes over logits
-                p_theta_marg = p_theta_marg / p_theta_marg.sum(axis=1, keepdim=True)  # renormalize probabilities at each position before KL
-                p_theta_marg = p_theta_marg.to(tgt.device)
-
-                # calculate q_t_minus_1, simplified for loops
-                num = torch.mul(A, B)
-                denom = torch.bmm(torch.mm(x_0, Q_bar[timestep[i] - 1]).unsqueeze(1), x_t.unsqueeze(2))
-                q_t_minus1 = num / denom.squeeze().unsqueeze(1)
-
-                kl_loss_i = super().forward(p_theta_marg.log(), q_t_minus1)  # KLDivLoss expects input in log-space
+                log_pred = log_p[i, :, :D, :self.K].flatten(start_dim=0, end_dim=1) # [pos x tokens]
+                x_t = _token_ids(src[i, :, :D], 2, self.K).flatten() # [pos]
+                x_0 = _token_ids(tgt[i, :, :D], 2, self.K).flatten()
+                log_Q_t = log_transition(Q[timestep[i]], dtype)
+                log_Q_bar_prev = log_transition(Q_bar[timestep[i] - 1], dtype)
+                # Sum the KL over chunks of positions, checkpointed so only the chunk inputs are kept for backward
+                kl_sum = 0
+                for start in range(0, len(log_pred), self.chunk_size):
+                    chunk = slice(start, start + self.chunk_size)
+                    if torch.is_grad_enabled() and log_pred.requires_grad:
+                        kl_sum = kl_sum + checkpoint(_posterior_kl_sum, log_pred[chunk], x_t[chunk], x_0[chunk], log_Q_t,
+                                                     log_Q_bar_prev, use_reentrant=False)
+                    else:
+                        kl_sum = kl_sum + _posterior_kl_sum(log_pred[chunk], x_t[chunk], x_0[chunk], log_Q_t,
+                                                            log_Q_bar_prev)
+                kl_loss_i = kl_sum / len(log_pred) # batchmean over positions
                 losses.append(kl_loss_i)
 
         losses = torch.stack(losses)
+        if self.reduction == 'none':
+            return losses
         lvb = ((losses.sum()) / (tgt.shape[0]))  # loss per batch, norm by batchsize
         return lvb
\ No newline at end of file
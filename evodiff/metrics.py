@@ -22,4 +22,43 @@ class MaskedAccuracyMSA(object):
         #print("target/pred", masked_tgt, p)
         #print("p", p.shape, p)
         accu = torch.mean((p == masked_tgt).float())
-        return accu
\ No newline at end of file
+        return accu
+
+class MetricAccumulator(object):
+    """
+    Sums per step metrics in a single device tensor, so logging does not sync the host with the device every step.
+    reduce() sums the pending values over ranks with one packed all_reduce and is the only point they reach the host.
+    Inputs:
+        names: metric names, in the order values are passed to add()
+        device: device of the zeros a rank without any steps contributes to reduce()
+
+    Outputs: reduce() returns {name: float} of the sums since the last reset(), with with_local also the sums of this
+        rank alone, read back in the same transfer
+    """
+    def __init__(self, names, device=None):
+        self.names = list(names)
+        self.device = device
+        self.total = None
+        self.steps = 0
+
+    def add(self, *values):
+        values = torch.stack([v.detach().to(torch.float64).reshape(()) for v in values])
+        self.total = values if self.total is None else self.total + values
+        self.steps += 1
+
+    def reduce(self, distributed=True, with_local=False):
+        if self.total is None: # e.g. a validation shard with no batches still joins the collective
+            local = torch.zeros(len(self.names), dtype=torch.float64, device=self.device)
+        else:
+            local = self.total
+        total = local.clone()
+        if distributed and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(total)
+        if not with_local:
+            return dict(zip(self.names, total.tolist()))
+        values = torch.cat([total, local]).tolist()
+        return dict(zip(self.names, values[:len(self.names)])), dict(zip(self.names, values[len(self.names):]))
+
+    def reset(self):
+        self.total = None
+        self.steps = 0
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 import numpy as np
 from torch.utils.checkpoint import checkpoint
 from sequence_models.layers import PositionFeedForward, DoubleEmbedding
-from sequence_models.convolutional import ByteNetBlock
+from sequence_models.convolutional import ByteNetBlock, MaskedCausalConv1d
 from sequence_models.constants import MSA_PAD, MASK, MSA_ALPHABET
 from esm.modules import TransformerLayer, LearnedPositionalEmbedding, RobertaLMHead, ESM1bLayerNorm, AxialTransformerLayer
 
@@ -72,7 +72,7 @@ class ByteNetTime(nn.Module):
 
     def __init__(self, n_tokens, d_embedding, d_model, n_layers, kernel_size, r, rank=None, n_frozen_embs=None,
                  padding_idx=None, causal=False, dropout=0.0, slim=True, activation='relu', down_embed=True,
-                 timesteps=None):
+                 timesteps=None, ckpt_every=0):
         """
         :param n_tokens: number of tokens in token dictionary
         :param d_embedding: dimension of embedding
@@ -88,9 +88,12 @@ class ByteNetTime(nn.Module):
         :param activation: 'relu' or 'gelu'
         :param down_embed: if True, have lower dimension for initial embedding than in CNN layers
         :param timesteps: None or int providing max timesteps in DM model
+        :param ckpt_every: if > 0, checkpoint activations in segments of this many blocks when training, keeping only
+            the segment inputs and recomputing the blocks in backward; 1 checkpoints every block
         """
         super().__init__()
         self.timesteps = timesteps
+        self.ckpt_every = ckpt_every
         self.time_encoding = PositionalEncoding1D(d_embedding, timesteps) # Timestep encoding
         if n_tokens is not None:
             if n_frozen_embs is None:
@@ -118,45 +121,89 @@ class ByteNetTime(nn.Module):
         self.layers = nn.ModuleList(modules=layers)
         self.dropout = dropout
 
-    def forward(self, x, y, input_mask=None):
+    def forward(self, x, y, input_mask=None, segments=None):
         """
         :param x: (batch, length)
-        :param y: (batch)
+        :param y: (batch), or (batch, length) timesteps per position for packed rows
         :param input_mask: (batch, length, 1)
+        :param segments: (batch, length) segment ids of packed rows, -1 where empty, convolutions do not cross them
         :return: (batch, length,)
         """
         e = self._embed(x, y, timesteps=self.timesteps)
-        return self._convolve(e, input_mask=input_mask)
+        return self._convolve(e, input_mask=input_mask, segments=segments)
 
     def _embed(self, x, y, timesteps=None):
         e = self.embedder(x)
         if timesteps is not None:
             e2 = self.time_encoding(y)
-            # expand dim of e2 to match e1
-            e2 = e2.expand(e.shape[1], e2.shape[0], e2.shape[1])
-            e2 = e2.reshape(e.shape[0], e.shape[1], e.shape[2])
+            if y.dim() == 1:
+                # expand dim of e2 to match e1
+                e2 = e2.expand(e.shape[1], e2.shape[0], e2.shape[1])
+                e2 = e2.reshape(e.shape[0], e.shape[1], e.shape[2])
             e = torch.add(e2, e)
         e = self.up_embedder(e)
         return e
 
-    def _convolve(self, e, input_mask=None):
-        for layer in self.layers:
-            e = layer(e, input_mask=input_mask)
+    def _convolve(self, e, input_mask=None, segments=None):
+        if self.ckpt_every > 0 and torch.is_grad_enabled():
+            for start in range(0, len(self.layers), self.ckpt_every):
+                e = checkpoint(self._convolve_layers, e, input_mask, segments, start, start + self.ckpt_every,
+                               use_reentrant=False)
+            return e
+        return self._convolve_layers(e, input_mask, segments, 0, len(self.layers))
+
+    def _convolve_layers(self, e, input_mask, segments, start, end):
+        for layer in self.layers[start:end]:
+            if segments is None:
+                e = layer(e, input_mask=input_mask)
+            else:
+                e = _packed_block(layer, e, input_mask, segments)
             if self.dropout > 0.0:
                 e = F.dropout(e, self.dropout)
         return e
 
 
+def _segment_conv(conv, x, segments):
+    """
+    MaskedConv1d or MaskedCausalConv1d over packed rows, computed tap by tap so each tap only reads positions of the
+    same segment; taps that would cross into another sequence see zeros, like the padding of an unpacked batch
+    x: (N, L, C) masked input, segments: (N, L) segment ids, -1 where empty
+    """
+    if isinstance(conv, MaskedCausalConv1d):
+        conv, start = conv.conv, conv.zeros
+    else:
+        start = conv.padding[0]
+    if conv.groups != 1:
+        raise ValueError("Packed convolutions need groups=1")
+    length = x.shape[1]
+    offsets = [j * conv.dilation[0] - start for j in range(conv.kernel_size[0])]
+    pad = max(abs(o) for o in offsets)
+    x_pad = F.pad(x, (0, 0, pad, pad))
+    seg_pad = F.pad(segments, (pad, pad), value=-2)
+    out = 0
+    for j, o in enumerate(offsets):
+        same = (seg_pad[:, pad + o:pad + o + length] == segments).unsqueeze(-1).to(x.dtype)
+        out = out + F.linear(x_pad[:, pad + o:pad + o + length] * same, conv.weight[:, :, j])
+    if conv.bias is not None:
+        out = out + conv.bias
+    return out
+
+
+def _packed_block(layer, x, input_mask, segments):
+    "ByteNetBlock forward on packed rows, with its masked convolution replaced by _segment_conv"
+    return x + layer.sequence2(_segment_conv(layer.conv, layer.sequence1(x) * input_mask, segments))
+
+
 class ByteNetLMTime(nn.Module):
 
     def __init__(self, n_tokens, d_embedding, d_model, n_layers, kernel_size, r, rank=None, n_frozen_embs=None,
                  padding_idx=None, causal=False, dropout=0.0, final_ln=False, slim=True, activation='relu',
-                 tie_weights=False, down_embed=True, timesteps=None):
+                 tie_weights=False, down_embed=True, timesteps=None, ckpt_every=0):
         super().__init__()
         self.embedder = ByteNetTime(n_tokens, d_embedding, d_model, n_layers, kernel_size, r,
                                 padding_idx=padding_idx, causal=causal, dropout=dropout, down_embed=down_embed,
                                 slim=slim, activation=activation, rank=rank, n_frozen_embs=n_frozen_embs,
-                                timesteps=timesteps)
+                                timesteps=timesteps, ckpt_every=ckpt_every)
         if tie_weights:
             self.decoder = nn.Linear(d_model, n_tokens, bias=False)
             self.decoder.weight = self.embedder.embedder.weight
@@ -167,11 +214,143 @@ class ByteNetLMTime(nn.Module):
         else:
             self.last_norm = nn.Identity()
 
-    def forward(self, x, y, input_mask=None):
+    def forward(self, x, y, input_mask=None, pack_index=None):
+        """
+        :param x: (batch, length)
+        :param y: (batch)
+        :param input_mask: (batch, length, 1)
+        :param pack_index: optional (rows, pack_len) from PackingCollater, the model then runs on rows holding several
+            sequences and input_mask is ignored; outputs keep the padded layout of x
+        :return: (batch, length, n_tokens)
+        """
+        if pack_index is not None:
+            return self._forward_packed(x, y, pack_index)
         e = self.embedder(x, y, input_mask=input_mask)
         e = self.last_norm(e)
         return self.decoder(e)
 
+    def _forward_packed(self, x, y, pack_index):
+        filled = pack_index >= 0
+        flat = pack_index.clamp(min=0)
+        segments = torch.where(filled, flat // x.shape[1], -1) # sequence of each packed position
+        e = self.embedder(x.flatten()[flat], y[segments.clamp(min=0)], input_mask=filled.unsqueeze(-1).float(),
+                          segments=segments)
+        e = self.last_norm(e)
+        packed = self.decoder(e)
+        # scatter back to (batch, length), pad positions are zeros
+        out = packed.new_zeros(x.numel(), packed.shape[-1]).index_copy(0, flat[filled], packed[filled])
+        return out.view(*x.shape, -1)
+
+
+
+def _chunk_sizes(n, len_q, len_k, budget, element_size):
+    """
+    Pick query/key block sizes so that one [n x q_chunk x k_chunk] block of attention logits fits in budget bytes
+    """
+    max_elements = max(1, budget // (element_size * n))
+    k_chunk = int(min(len_k, max(1, np.sqrt(max_elements))))
+    q_chunk = int(min(len_q, max(1, max_elements // k_chunk)))
+    return q_chunk, k_chunk
+
+
+def chunked_attention(q, k, v, key_padding_mask=None, budget=2 ** 28):
+    """
+    Exact softmax attention computed over blocks of queries and keys with a streaming (online) softmax, so the full
+    [n x len_q x len_k] attention map is never materialised
+
+    :param q: (n, len_q, d) scaled queries
+    :param k: (n, len_k, d) keys
+    :param v: (n, len_k, d_v) values
+    :param key_padding_mask: (n, len_k) bool, True at padded keys (filled with -10000 as in esm)
+    :param budget: max bytes used by one block of attention logits
+    :return: (n, len_q, d_v) attention output
+    """
+    n, len_q, _ = q.shape
+    len_k = k.shape[1]
+    q_chunk, k_chunk = _chunk_sizes(n, len_q, len_k, budget, q.element_size())
+    output = torch.empty(n, len_q, v.shape[-1], dtype=v.dtype, device=v.device)
+    for q_start in range(0, len_q, q_chunk):
+        q_block = q[:, q_start:q_start + q_chunk]
+        running_max = torch.full(q_block.shape[:2] + (1,), -float('inf'), dtype=q.dtype, device=q.device)
+        running_sum = torch.zeros_like(running_max)
+        acc = torch.zeros(q_block.shape[:2] + (v.shape[-1],), dtype=v.dtype, device=v.device)
+        for k_start in range(0, len_k, k_chunk):
+            scores = torch.bmm(q_block, k[:, k_start:k_start + k_chunk].transpose(1, 2))
+            if key_padding_mask is not None:
+                scores = scores.masked_fill(key_padding_mask[:, None, k_start:k_start + k_chunk], -10000)
+            block_max = torch.maximum(running_max, scores.amax(dim=-1, keepdim=True))
+            correction = torch.exp(running_max - block_max)
+            weights = torch.exp(scores - block_max)
+            running_sum = running_sum * correction + weights.sum(dim=-1, keepdim=True)
+            acc = acc * correction + torch.bmm(weights, v[:, k_start:k_start + k_chunk])
+            running_max = block_max
+        output[:, q_start:q_start + q_chunk] = acc / running_sum
+    return output
+
+
+def _chunked_row_attention(attn, x, padding_mask, budget):
+    """
+    Tied row attention from esm.axial_attention.RowSelfAttention, computed with chunked_attention
+    x: R x C x B x D, padding_mask: B x R x C
+    """
+    num_rows, num_cols, batch_size, embed_dim = x.size()
+    h, d = attn.num_heads, attn.head_dim
+    q = attn.q_proj(x).view(num_rows, num_cols, batch_size, h, d) * attn.align_scaling(x)
+    if padding_mask is not None:
+        q = q * (1 - padding_mask.permute(1, 2, 0).unsqueeze(3).unsqueeze(4).to(q))
+    k = attn.k_proj(x).view(num_rows, num_cols, batch_size, h, d)
+    v = attn.v_proj(x).view(num_rows, num_cols, batch_size, h, d)
+    # Tied attention sums logits over rows: fold rows into the feature dim -> (B*H, C, R*d)
+    q, k, v = [t.permute(2, 3, 1, 0, 4).reshape(batch_size * h, num_cols, num_rows * d) for t in (q, k, v)]
+    key_mask = None
+    if padding_mask is not None:
+        key_mask = padding_mask[:, 0].unsqueeze(1).expand(batch_size, h, num_cols).reshape(batch_size * h, num_cols)
+    context = chunked_attention(q, k, v, key_padding_mask=key_mask, budget=budget)
+    context = context.view(batch_size, h, num_cols, num_rows, d).permute(3, 2, 0, 1, 4)
+    return attn.out_proj(context.reshape(num_rows, num_cols, batch_size, embed_dim))
+
+
+def _chunked_column_attention(attn, x, padding_mask, budget):
+    """
+    Column attention from esm.axial_attention.ColumnSelfAttention, computed with chunked_attention
+    x: R x C x B x D, padding_mask: B x R x C
+    """
+    num_rows, num_cols, batch_size, embed_dim = x.size()
+    if num_rows == 1:
+        return attn.out_proj(attn.v_proj(x))
+    h, d = attn.num_heads, attn.head_dim
+    q = attn.q_proj(x).view(num_rows, num_cols, batch_size, h, d) * attn.scaling
+    k = attn.k_proj(x).view(num_rows, num_cols, batch_size, h, d)
+    v = attn.v_proj(x).view(num_rows, num_cols, batch_size, h, d)
+    # Independent attention over rows for every column -> (C*B*H, R, d)
+    q, k, v = [t.permute(1, 2, 3, 0, 4).reshape(num_cols * batch_size * h, num_rows, d) for t in (q, k, v)]
+    key_mask = None
+    if padding_mask is not None:
+        key_mask = padding_mask.permute(2, 0, 1).unsqueeze(2).expand(num_cols, batch_size, h, num_rows)
+        key_mask = key_mask.reshape(num_cols * batch_size * h, num_rows)
+    context = chunked_attention(q, k, v, key_padding_mask=key_mask, budget=budget)
+    context = context.view(num_cols, batch_size, h, num_rows, d).permute(3, 0, 1, 2, 4)
+    return attn.out_proj(context.reshape(num_rows, num_cols, batch_size, embed_dim))
+
+
+def _residual(block, x, fn):
+    "Apply an esm NormalizedResidualBlock with fn in place of its inner layer"
+    return x + block.dropout_module(fn(block.layer_norm(x)))
+
+
+def chunked_axial_layer(layer, x, padding_mask, budget):
+    """
+    Inference-only forward of an esm AxialTransformerLayer with chunked row and column attention
+
+    :param layer: esm.modules.AxialTransformerLayer
+    :param x: R x C x B x D
+    :param padding_mask: B x R x C
+    :param budget: max bytes for one block of attention logits
+    """
+    row, column = layer.row_self_attention, layer.column_self_attention
+    x = _residual(row, x, lambda y: _chunked_row_attention(row.layer, y, padding_mask, budget))
+    x = _residual(column, x, lambda y: _chunked_column_attention(column.layer, y, padding_mask, budget))
+    return layer.feed_forward_layer(x)
 
 
 class MSATransformerTime(nn.Module):
@@ -187,11 +366,14 @@ class MSATransformerTime(nn.Module):
            number of layers
        n_heads: int,
            number of attention heads
+       attention_budget: int,
+           if set, max bytes for one block of attention logits; row and column attention are then computed in
+           chunks with a streaming softmax whenever gradients are disabled (inference)
    """
 
     def __init__(self, d_model, d_hidden, n_layers, n_heads, use_ckpt=False, n_tokens=len(MSA_ALPHABET),
                  padding_idx=MSA_ALPHABET.index(MSA_PAD), mask_idx=MSA_ALPHABET.index(MASK),
-                 max_positions=1024, timesteps=None):
+                 max_positions=1024, timesteps=None, attention_budget=None):
         super(MSATransformerTime, self).__init__()
 
         self.timesteps = timesteps
@@ -220,6 +402,7 @@ class MSATransformerTime(nn.Module):
         )
 
         self.use_ckpt = use_ckpt
+        self.attention_budget = attention_budget
 
     def forward(self, tokens, timesteps):
         assert tokens.ndim == 3
@@ -246,8 +429,12 @@ class MSATransformerTime(nn.Module):
         # B x R x C x D -> R x C x B x D
         x = x.permute(1, 2, 0, 3)
 
+        chunked = self.attention_budget is not None and not torch.is_grad_enabled()
         for layer_idx, layer in enumerate(self.layers):
-            x = checkpoint(layer, x, None, padding_mask, False)
+            if chunked:
+                x = chunked_axial_layer(layer, x, padding_mask, self.attention_budget)
+            else:
+                x = checkpoint(layer, x, None, padding_mask, False)
 
         x = self.emb_layer_norm_after(x)
         x = x.permute(2, 0, 1, 3)  # R x C x B x D -> B x R x C x D
@@ -0,0 +1,176 @@
+import copy
+
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler
+
+
+class LossAwareTimestepSampler(object):
+    """
+    Importance sampler over diffusion timesteps 1..num_timesteps-1 for the D3PM collaters
+    Timesteps are drawn with p(t) proportional to the root mean square of the last history losses seen at t, mixed
+    with uniform_prob of the uniform distribution, and returned with weights 1 / (n p(t)) so the weighted loss has the
+    same expectation as under uniform sampling. Until every timestep has a full history it samples uniformly.
+
+    The probabilities are kept in shared memory, so DataLoader workers that hold a copy of the collater sample from
+    the latest update() made by the training process.
+    inputs:
+        num_timesteps: number of diffusion timesteps, samples t in [1, num_timesteps) like np.random.randint
+        history: number of recent losses kept per timestep
+        uniform_prob: fraction of uniform sampling mixed in, keeps every timestep reachable
+    """
+    def __init__(self, num_timesteps, history=10, uniform_prob=0.001):
+        self.timesteps = np.arange(1, num_timesteps)
+        self.history = history
+        self.uniform_prob = uniform_prob
+        self.losses = np.zeros((len(self.timesteps), history))
+        self.counts = np.zeros(len(self.timesteps), dtype=np.int64)
+        self.probs = torch.full((len(self.timesteps),), 1 / len(self.timesteps), dtype=torch.float64).share_memory_()
+
+    def sample(self, size):
+        "Returns (timesteps, weights) tensors of length size"
+        p = self.probs.numpy().copy() # snapshot, the training process may update probs concurrently
+        p /= p.sum()
+        idx = np.random.choice(len(p), size=size, p=p)
+        return torch.from_numpy(self.timesteps[idx]), torch.from_numpy(1 / (len(p) * p[idx]))
+
+    def update(self, timesteps, losses):
+        "Add the per sample (unweighted) losses at timesteps to the history and recompute the probabilities"
+        idx = timesteps.detach().cpu().numpy() - self.timesteps[0]
+        losses = losses.detach().to(torch.float64).cpu().numpy()
+        for i, loss in zip(idx, losses):
+            self.losses[i, self.counts[i] % self.history] = loss
+            self.counts[i] += 1
+        self._update_probs()
+
+    def _update_probs(self):
+        if (self.counts < self.history).any(): # warm up uniformly
+            return
+        p = np.sqrt((self.losses ** 2).mean(axis=1))
+        p = p / p.sum() if p.sum() > 0 else np.full(len(p), 1 / len(p))
+        p = p * (1 - self.uniform_prob) + self.uniform_prob / len(p)
+        self.probs.copy_(torch.from_numpy(p))
+
+    def state_dict(self):
+        return {'losses': self.losses.copy(), 'counts': self.counts.copy()}
+
+    def load_state_dict(self, state_dict):
+        self.losses = np.asarray(state_dict['losses'], dtype=np.float64).copy()
+        self.counts = np.asarray(state_dict['counts'], dtype=np.int64).copy()
+        self._update_probs()
+
+
+class PackedBatchSampler(BatchSampler):
+    """
+    Batches indices of a base sampler (e.g. SortishSampler) by the sum of their lengths, for batches that
+    PackingCollater packs into rows; ApproxBatchSampler instead budgets batch size * longest length, counting padding
+    inputs:
+        sampler: base sampler
+        max_tokens: max sum of sequence lengths per batch
+        max_batch: max number of sequences per batch
+        sample_lengths: lengths of sequences in the order of the dataset
+    """
+    def __init__(self, sampler, max_tokens, max_batch, sample_lengths):
+        self.sampler = sampler
+        self.max_tokens = max_tokens
+        self.max_batch = max_batch
+        self.sample_lengths = sample_lengths
+
+    def __iter__(self):
+        batch = []
+        tokens = 0
+        for idx in self.sampler:
+            length = self.sample_lengths[idx]
+            if len(batch) > 0 and (tokens + length > self.max_tokens or len(batch) == self.max_batch):
+                yield batch
+                batch = []
+                tokens = 0
+            batch.append(idx)
+            tokens += length
+        if len(batch) > 0:
+            yield batch
+
+    def __len__(self):
+        # Batch boundaries depend on the order of the base sampler, so count them over a dry run of a copy of it and
+        # restore the random state, the next pass over self then draws the same order that was counted
+        np_state, torch_state = np.random.get_state(), torch.get_rng_state()
+        try:
+            dry_run = PackedBatchSampler(copy.deepcopy(self.sampler), self.max_tokens, self.max_batch,
+                                         self.sample_lengths)
+            return sum(1 for _ in dry_run)
+        finally:
+            np.random.set_state(np_state)
+            torch.set_rng_state(torch_state)
+
+
+class MSABucketBatchSampler(BatchSampler):
+    """
+    Batches MSAs bucketed by their subsampled (depth, length) shape, filling each batch up to a budget of padded cells
+    (batch size * depth * length at the largest shape in the batch). MSAs are sorted by shape and split into buckets of
+    bucket_size, every epoch each bucket is shuffled and cut into batches, and the batches of all buckets are shuffled
+    together. Batches are then dealt round robin to the DDP ranks, repeating the first batches so every rank takes the
+    same number of steps.
+
+    max_tokens and max_square_tokens are the attention budgets of ApproxBatchSampler, with the batch's own depth in
+    place of a fixed msa_depth.
+    inputs:
+        depths: subsampled depth of each MSA in the order of the dataset
+        lengths: subsampled length of each MSA in the order of the dataset
+        max_cells: max batch size * depth * length per batch
+        max_batch: max number of MSAs per batch
+        max_tokens: max batch size * (length * depth ** 2 + length ** 2 * depth) per batch
+        max_square_tokens: max batch size * length ** 2 per batch
+        bucket_size: number of MSAs of similar shape per bucket
+        num_replicas, rank: DDP world size and rank
+        seed: batches are shuffled with seed + epoch, identical on all ranks
+    """
+    def __init__(self, depths, lengths, max_cells, max_batch, max_tokens=np.inf, max_square_tokens=np.inf,
+                 bucket_size=1000, num_replicas=1, rank=0, seed=0):
+        self.depths = np.asarray(depths, dtype=np.int64)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_cells = max_cells
+        self.max_batch = max_batch
+        self.max_tokens = max_tokens
+        self.max_square_tokens = max_square_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        order = np.lexsort((self.lengths, self.depths)) # by depth, then length
+        self.buckets = [order[i:i + bucket_size] for i in range(0, len(order), bucket_size)]
+
+    def _fits(self, n, depth, length):
+        return (n * depth * length <= self.max_cells
+                and n * (length * depth ** 2 + length ** 2 * depth) <= self.max_tokens
+                and n * length ** 2 < self.max_square_tokens)
+
+    def _batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            batch = []
+            depth = length = 0
+            for idx in rng.permutation(bucket):
+                d = max(depth, self.depths[idx])
+                ell = max(length, self.lengths[idx])
+                if len(batch) > 0 and (len(batch) == self.max_batch or not self._fits(len(batch) + 1, d, ell)):
+                    batches.append(batch)
+                    batch = []
+                    d, ell = self.depths[idx], self.lengths[idx]
+                batch.append(int(idx))
+                depth, length = d, ell
+            if len(batch) > 0:
+                batches.append(batch)
+        batches = [batches[i] for i in rng.permutation(len(batches))]
+        n_batches = int(np.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+        batches = [batches[i % len(batches)] for i in range(n_batches)]
+        return batches[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
@@ -5,7 +5,12 @@ from sequence_models.constants import MASK, MSA_PAD, MSA_ALPHABET, MSA_AAS, GAP,
 from evodiff.constants import BLOSUM_ALPHABET
 from sklearn.preprocessing import normalize
 import itertools
+import contextlib
+import tempfile
+import threading
+import time
 from collections import Counter, OrderedDict
+from functools import cached_property
 import csv
 import pandas as pd
 import subprocess
@@ -79,6 +84,31 @@ def cumprod_matrix(a):
         a_bar.append(a_prod_temp)  # update start
     return a_bar
 
+def log_transition(Q, dtype=torch.float32):
+    """
+    Log of transition matrices (Q or Q_bar), taken in the precision of Q before casting to dtype
+    Zeros are clamped to the smallest normal value so the log-table stays finite
+    """
+    return Q.clamp_min(torch.finfo(Q.dtype).tiny).log().to(dtype)
+
+def log_matmul_exp(a, b):
+    """
+    log(exp(a) @ exp(b)), shifting by the max of each row of a and each column of b so nothing under/overflows
+    """
+    a_max = a.amax(dim=-1, keepdim=True).detach()
+    b_max = b.amax(dim=-2, keepdim=True).detach()
+    return torch.matmul((a - a_max).exp(), (b - b_max).exp()).log() + a_max + b_max
+
+def log_p_theta_marg(log_pred, log_A, log_Q_bar_prev):
+    """
+    Log-space p_theta_marg, log(A * (pred^2 @ Q_bar[t-1])) normalized over the last dim with logsumexp
+        log_pred: [... x P x K] model log probabilities
+        log_A: [... x P x K] log of x_t Q[t]^T
+        log_Q_bar_prev: [... x K x K] log Q_bar[t-1]
+    """
+    log_p = log_A + log_matmul_exp(2 * log_pred, log_Q_bar_prev)
+    return log_p - torch.logsumexp(log_p, dim=-1, keepdim=True)
+
 def softmax(x):
     """
     Compute softmax over x
@@ -112,6 +142,172 @@ def _beta_schedule(num_timesteps, schedule='linear', start=1e-5, end=0.999, max=
         print("Must select a valid schedule; ['linear', 'sohl-dickstein', 'cosine', 'exp']")
     return betas
 
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(device, precision='fp32'):
+    "Autocast context for the model forward on device at precision in PRECISIONS, a no-op for fp32"
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=PRECISIONS[precision])
+
+def broadcast_flag(flag, device):
+    "Rank 0's value of a host side flag on every rank, for decisions such as time based checkpoints that all ranks take"
+    if not torch.distributed.is_initialized():
+        return bool(flag)
+    flag = torch.tensor(float(flag), device=device)
+    torch.distributed.broadcast(flag, 0)
+    return bool(flag)
+
+class GradAccumulator(object):
+    """
+    Gradient accumulation over iters micro-batches, or until tokens loss tokens have been seen over all ranks.
+    Micro-batches that do not end the window run forward and backward under DDP no_sync, so the window's gradient is
+    the sum of the per token loss gradients of all its micro-batches, averaged over ranks by DDP. That is the scale of
+    an unaccumulated step (iters=1, tokens=None), so accumulating N micro-batches matches one N times larger batch.
+
+    With normalize, normalize_grads() divides the gradient of every optimizer step, accumulated or not, by the loss
+    tokens of its window over all ranks, a mean instead of a sum over tokens. Weight decay and gradient clipping then
+    act on a gradient that no longer grows with the batch, so it is an explicit option, off by default.
+
+    Windows do not carry across epochs: the training scripts close a window still open after the last micro-batch
+    of an epoch with sync_grads() and an optimizer step on the partial window, before the end of epoch checkpoint.
+    With tokens set, add() all-reduces the token count and reads it back on the host every micro-batch, so token
+    windows cost one small collective and one device sync per micro-batch.
+    inputs:
+        iters: micro-batches per optimizer step
+        tokens: loss tokens per optimizer step summed over ranks, overrides iters
+        normalize: divide gradients by the loss tokens of their window
+    """
+    def __init__(self, iters=1, tokens=None, normalize=False):
+        self.iters = iters
+        self.tokens = tokens
+        self.normalize = normalize
+        self.n_iters = 0
+        self.n_tokens = 0
+
+    @property
+    def enabled(self):
+        return self.iters > 1 or self.tokens is not None
+
+    def add(self, n_tokens):
+        "Counts a micro-batch with n_tokens loss tokens on this rank, returns True if it ends the window"
+        if not self.enabled and not self.normalize:
+            return True
+        self.n_iters += 1
+        n_tokens = n_tokens.detach().float().clone()
+        if self.tokens is None:
+            self.n_tokens = self.n_tokens + n_tokens
+            return self.n_iters >= self.iters
+        if torch.distributed.is_initialized(): # every rank must agree on the last micro-batch
+            torch.distributed.all_reduce(n_tokens)
+        self.n_tokens = self.n_tokens + n_tokens
+        return bool(self.n_tokens >= self.tokens)
+
+    def sync(self, model, sync):
+        "Context for the forward and backward pass of a micro-batch, skips the DDP all-reduce unless sync"
+        if sync or not hasattr(model, 'no_sync'):
+            return contextlib.nullcontext()
+        return model.no_sync()
+
+    def normalize_grads(self, parameters):
+        """
+        Ends the window, called with unscaled gradients before every optimizer step. With normalize, divides the
+        gradients by the tokens in the window, and since DDP averages gradients over ranks also multiplies them by the
+        world size. Otherwise they are left untouched.
+        """
+        if not self.normalize:
+            self.n_iters = 0
+            self.n_tokens = 0
+            return
+        n_tokens = self.n_tokens
+        if self.tokens is None and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(n_tokens)
+        world_size = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        scale = world_size / n_tokens.clamp(min=1)
+        for p in parameters:
+            if p.grad is not None:
+                p.grad.mul_(scale.to(p.grad.device))
+        self.n_iters = 0
+        self.n_tokens = 0
+
+    def sync_grads(self, parameters):
+        """
+        Averages gradients over ranks as DDP does, for a window closed after micro-batches that all ran under
+        no_sync. Call before unscaling, so every rank's GradScaler sees the same inf checks. Every rank holds the same
+        window, so all of them call it together.
+        """
+        if not torch.distributed.is_initialized():
+            return
+        world_size = torch.distributed.get_world_size()
+        for p in parameters:
+            if p.grad is not None:
+                torch.distributed.all_reduce(p.grad)
+                p.grad.div_(world_size)
+
+def _to_cpu(obj):
+    "Copy of a (nested) state dict with every tensor copied to CPU memory"
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+class AsyncCheckpointer(object):
+    """
+    Writes checkpoints without blocking training: save() copies the state to CPU memory and returns, a background
+    thread torch.saves the copy to a temporary file in the same directory and renames it over fpath, so a checkpoint
+    file is never partially written. One write is in flight at a time, a second save() first waits for it.
+    inputs:
+        keep: if set, only the last keep checkpoints written by this object are kept on disk
+    """
+    def __init__(self, keep=None):
+        self.keep = keep
+        self.written = []
+        self.thread = None
+        self.error = None
+
+    def save(self, state, fpath):
+        "Snapshots state and starts writing it to fpath, returns the seconds the snapshot blocked training"
+        self.wait()
+        start = time.time()
+        snapshot = _to_cpu(state)
+        elapsed = time.time() - start
+        self.thread = threading.Thread(target=self._write, args=(snapshot, fpath))
+        self.thread.start()
+        return elapsed
+
+    def _write(self, snapshot, fpath):
+        tmp_fpath = None
+        try:
+            fd, tmp_fpath = tempfile.mkstemp(dir=os.path.dirname(fpath) or '.', prefix='.saving-')
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(snapshot, f)
+            os.replace(tmp_fpath, fpath)
+            tmp_fpath = None
+            if fpath in self.written:
+                self.written.remove(fpath)
+            self.written.append(fpath)
+            while self.keep is not None and len(self.written) > self.keep:
+                old = self.written.pop(0)
+                if os.path.exists(old):
+                    os.remove(old)
+        except Exception as e:
+            self.error = e
+        finally:
+            if tmp_fpath is not None and os.path.exists(tmp_fpath): # failed before the rename, e.g. disk full
+                os.remove(tmp_fpath)
+
+    def wait(self):
+        "Blocks until the last checkpoint is on disk, raising any error from writing it"
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
 def read_fasta(fasta_path, seq_file, info_file, index_file):
     """
     Read fasta and extract sequences, write out a corresponding index file w/ headers
@@ -160,6 +356,13 @@ class Tokenizer(object):
         self.sep = sep
         self.a_to_i = {u: i for i, u in enumerate(self.alphabet)}
         self.i_to_a = np.array(self.alphabet)
+        # Lookup tables for vectorized encode (byte -> index, -1 if not in alphabet) and decode (index -> byte)
+        self.a_to_i_table = np.full(256, -1, dtype=np.int64)
+        for a, i in self.a_to_i.items():
+            if ord(a) < 256:
+                self.a_to_i_table[ord(a)] = i
+        self.byte_alphabet = all(ord(a) < 256 for a in self.alphabet)
+        self.i_to_a_table = np.array([ord(a) if ord(a) < 256 else 0 for a in self.alphabet], dtype=np.uint8)
         if path_to_blosum is not None:
             self.matrix = loadMatrix(path_to_blosum)
             self.matrix_dict = dict(self.matrix)
@@ -169,27 +372,28 @@ class Tokenizer(object):
             self.K = len(self.all_aas[:-1]) # slice out GAPS for sequences
         #print("K is :", self.K)
 
-    @property
+    # Special ids are computed on first access and cached
+    @cached_property
     def pad_id(self):
          return self.tokenize(self.pad)[0]
 
-    @property
+    @cached_property
     def mask_id(self):
         return self.tokenize(self.mask)[0]
 
-    @property
+    @cached_property
     def gap_id(self):
         return self.tokenize(self.gap)[0]
 
-    @property
+    @cached_property
     def start_id(self):
         return self.tokenize(self.start)[0]
 
-    @property
+    @cached_property
     def stop_id(self):
         return self.tokenize(self.stop)[0]
 
-    @property
+    @cached_property
     def sep_id(self):
         return self.tokenize(self.sep)[0]
 
@@ -248,18 +452,59 @@ class Tokenizer(object):
         Q_t = torch.stack(Q_t)  # scheduled matrix
         return Q_prod, Q_t
 
+    def _encode(self, seq):
+        "str -> int64 array of indices through the lookup table, falls back to a_to_i for anything else"
+        if isinstance(seq, str) and len(seq) > 0:
+            try:
+                tokens = self.a_to_i_table[np.frombuffer(seq.encode('latin-1'), dtype=np.uint8)]
+                if (tokens >= 0).all():
+                    return tokens
+            except UnicodeEncodeError:
+                pass
+        return np.array([self.a_to_i[a] for a in seq]) # raises KeyError on unknown characters
+
     def tokenize(self, seq):
-        return np.array([self.a_to_i[a] for a in seq[0]]) # for nested lists
+        return self._encode(seq[0]) # for nested lists
 
     def tokenizeMSA(self, seq):
-        return np.array([self.a_to_i[a] for a in seq]) # not nested
+        return self._encode(seq) # not nested
+
+    def tokenize_batch(self, seqs, pad_value=None):
+        """
+        Tokenize a list of sequences into one (N, max_len) int64 array, padded with pad_value (default pad_id)
+        """
+        tokenized = [self._encode(seq) for seq in seqs]
+        max_len = max(len(t) for t in tokenized)
+        output = np.full((len(tokenized), max_len), self.pad_id if pad_value is None else pad_value,
+                         dtype=np.int64)
+        for row, t in enumerate(tokenized):
+            output[row, :len(t)] = t
+        return output
+
+    def _decode(self, x):
+        "int array (any shape) -> uint8 array of characters"
+        if torch.is_tensor(x):
+            x = x.detach().cpu().numpy()
+        return self.i_to_a_table[np.asarray(x).astype(np.int64)]
 
     def untokenize(self, x):
+        if self.byte_alphabet:
+            return self._decode(x).tobytes().decode('latin-1')
         if torch.is_tensor(x):
             return "".join([self.i_to_a[int(t.item())] for t in x])
         else:
             return "".join([self.i_to_a[t] for t in x])
 
+    def untokenize_batch(self, x):
+        """
+        Untokenize a 2D (N, L) or 3D (B, N, L) array/tensor of tokens; returns nested lists of strings
+        """
+        if not self.byte_alphabet:
+            return [self.untokenize_batch(t) if t.ndim > 2 else [self.untokenize(s) for s in t] for t in x]
+        chars = self._decode(x)
+        strings = [row.tobytes().decode('latin-1') for row in chars.reshape(-1, chars.shape[-1])]
+        return np.array(strings, dtype=object).reshape(chars.shape[:-1]).tolist()
+
     def one_hot(self, tokenized):
         "one hot encode according to indexing"
         #print(tokenized, self.K)
@@ -0,0 +1,99 @@
+import os
+
+import pytest
+import torch
+
+from evodiff.collaters import onehot_tokens, sample_transition_tokens
+from evodiff.losses import D3PMCELoss, D3PMLVBLoss, D3PMLVBLossMSA
+from evodiff.utils import Tokenizer
+
+T = 500
+RTOL = 2e-4
+ATOL = 1e-6
+BLOSUM = os.path.join(os.path.dirname(__file__), '..', 'data', 'blosum62-special-MSA.mat')
+
+
+def reference_lvb(tokenizer, pred, x_t, x_0, tgt, input_mask, t, Q, Q_bar, msa=False):
+    """
+    Float64 probability space loss of one sample, as computed before the log-space rewrite: cross entropy at t = 1,
+    KL(q(x_t-1 | x_t, x_0) || p_theta) otherwise
+    pred: (..., n_tokens) logits; x_t, x_0: (..., K) one hots
+    """
+    K = tokenizer.K
+    if t == 1:
+        return D3PMCELoss(tokenizer=tokenizer, sequences=not msa)(pred.double().unsqueeze(0), tgt.unsqueeze(0),
+                                                                   input_mask.unsqueeze(0))
+    keep = input_mask.bool()
+    p = torch.softmax(pred[..., :K].double(), -1)[keep]
+    x_t = x_t[keep].double()
+    x_0 = x_0[keep].double()
+    A = x_t @ Q[t].t()
+    p_theta_marg = A * ((p * p) @ Q_bar[t - 1])
+    p_theta_marg = p_theta_marg / p_theta_marg.sum(1, keepdim=True)
+    # the MSA loss normalizes q(x_t-1 | x_t, x_0) with Q_bar[t-1], the sequence loss with Q_bar[t]
+    denom = ((x_0 @ Q_bar[t - 1 if msa else t]) * x_t).sum(1, keepdim=True)
+    q_t_minus1 = A * (x_0 @ Q_bar[t - 1]) / denom
+    return torch.nn.functional.kl_div(p_theta_marg.log(), q_t_minus1, reduction='batchmean')
+
+
+def batch(tokenizer, t, Q_bar, msa, generator):
+    "Two samples of different lengths at timestep t: x_0, x_t ~ Q_bar[t][x_0], logits, masks and one hots"
+    K = tokenizer.K
+    lengths = [17, 40]
+    shape = (2, 3, max(lengths)) if msa else (2, max(lengths))
+    tgt = torch.randint(0, K, shape, generator=generator)
+    for i, length in enumerate(lengths):
+        tgt[i, ..., length:] = tokenizer.pad_id
+    timestep = torch.full((2,), t)
+    src, q = sample_transition_tokens(tgt, timestep, Q_bar, K, tokenizer.pad_id)
+    input_mask = (tgt != tokenizer.pad_id).float()
+    logits = torch.randn(shape + (len(tokenizer.alphabet),), generator=generator) * (1 + t % 20)
+    return src, onehot_tokens(src, K), timestep, tgt, onehot_tokens(tgt, K), q, logits, input_mask
+
+
+@pytest.mark.parametrize('msa', [False, True], ids=['sequence', 'msa'])
+@pytest.mark.parametrize('schedule', ['blosum', 'random'])
+def test_lvb_matches_float64_reference(msa, schedule):
+    tokenizer = Tokenizer(path_to_blosum=BLOSUM, sequences=not msa)
+    if schedule == 'blosum':
+        Q_bar, Q = tokenizer.q_blosum_schedule(timesteps=T)
+    else:
+        Q_bar, Q = tokenizer.q_random_schedule(timesteps=T)
+    if msa:
+        loss_func = D3PMLVBLossMSA(tmax=T, tokenizer=tokenizer, reduction='none')
+    else:
+        loss_func = D3PMLVBLoss(tmax=T, tokenizer=tokenizer, reduction='none')
+    generator = torch.Generator().manual_seed(0)
+    torch.manual_seed(0) # sample_transition_tokens draws from the global generator
+    for t in range(1, T): # timesteps are drawn from [1, T)
+        src, src_onehot, timestep, tgt, tgt_onehot, q, logits, input_mask = batch(tokenizer, t, Q_bar, msa, generator)
+        losses = loss_func(src, q, logits, tgt, None, input_mask, timestep, Q, Q_bar)
+        assert losses.dtype == torch.float32
+        # one hot inputs are still accepted and give the same terms
+        assert torch.equal(losses, loss_func(src_onehot, q, logits, tgt, tgt_onehot, input_mask, timestep, Q, Q_bar))
+        for i in range(len(tgt)):
+            ref = reference_lvb(tokenizer, logits[i], src_onehot[i], tgt_onehot[i], tgt[i], input_mask[i], t, Q,
+                                Q_bar, msa=msa)
+            # measured: <= 1e-4 relative, up to 5e-4 relative (< 5e-7 absolute) where the loss is ~1e-3 or less
+            assert abs(losses[i].item() - ref.item()) <= RTOL * abs(ref.item()) + ATOL, (t, i)
+
+
+@pytest.mark.parametrize('reduction', ['none', 'batchmean'])
+def test_lvb_msa_per_msa_terms(reduction):
+    tokenizer = Tokenizer(path_to_blosum=BLOSUM, sequences=False)
+    Q_bar, Q = tokenizer.q_random_schedule(timesteps=T)
+    loss_func = D3PMLVBLossMSA(tmax=T - 1, tokenizer=tokenizer, reduction=reduction) # Q_bar[T - 1] is the last
+    generator = torch.Generator().manual_seed(0)
+    torch.manual_seed(0)
+    samples = [batch(tokenizer, t, Q_bar, True, generator) for t in (1, T // 2, T - 1)]
+    src, src_onehot, timestep, tgt, tgt_onehot, q, logits, input_mask = [torch.cat(x) for x in zip(*samples)]
+    losses = loss_func(src, q, logits, tgt, None, input_mask, timestep, Q, Q_bar)
+    if reduction == 'batchmean':
+        assert losses.dim() == 0
+        return
+    assert losses.shape == (len(tgt),) # one term per MSA at t = 1, 1 < t < tmax and t = tmax
+    assert torch.isfinite(losses).all()
+    last = timestep == T - 1
+    q_true = q[last][..., :17, :] # first MSA of the t = tmax sample, 17 non-pad positions
+    expected = (q_true[0] * (q_true[0].clamp(min=1e-30) * len(tokenizer.alphabet)).log()).sum(-1).mean()
+    assert torch.allclose(losses[last][0].double(), expected.double(), rtol=1e-4)
@@ -0,0 +1,18 @@
+import numpy as np
+from sequence_models.samplers import SortishSampler
+
+from evodiff.samplers import PackedBatchSampler
+
+
+def test_packed_batch_sampler_len():
+    lengths = np.random.RandomState(0).randint(10, 500, size=1000)
+    sampler = SortishSampler(lengths, 100, num_replicas=1, rank=0)
+    batch_sampler = PackedBatchSampler(sampler, 2000, 32, lengths)
+    for epoch in range(3):
+        sampler.set_epoch(epoch)
+        n_batches = len(batch_sampler)
+        batches = list(batch_sampler)
+        assert n_batches == len(batches)
+        assert sorted(i for batch in batches for i in batch) == list(range(len(lengths)))
+        assert all(len(batch) <= 32 for batch in batches)
+        assert all(len(batch) == 1 or lengths[batch].sum() <= 2000 for batch in batches)
@@ -0,0 +1,50 @@
+import os
+
+import pytest
+import torch
+
+from evodiff.utils import AsyncCheckpointer, GradAccumulator
+
+
+class Unpicklable(object):
+    def __reduce__(self):
+        raise RuntimeError('cannot pickle')
+
+
+def test_async_checkpointer_keeps_last(tmp_path):
+    checkpointer = AsyncCheckpointer(keep=2)
+    for step in range(3):
+        checkpointer.save({'step': step, 'weight': torch.full((3,), float(step))}, str(tmp_path / ('ckpt%d.tar' % step)))
+    checkpointer.wait()
+    assert sorted(os.listdir(tmp_path)) == ['ckpt1.tar', 'ckpt2.tar']
+    assert torch.load(tmp_path / 'ckpt2.tar')['step'] == 2
+
+
+def test_async_checkpointer_failed_write(tmp_path):
+    checkpointer = AsyncCheckpointer()
+    checkpointer.save({'weight': torch.ones(3), 'bad': Unpicklable()}, str(tmp_path / 'ckpt.tar'))
+    with pytest.raises(RuntimeError):
+        checkpointer.wait()
+    assert os.listdir(tmp_path) == [] # no partial checkpoint or temporary file left behind
+
+
+def accumulated_grad(accumulator, batches):
+    torch.manual_seed(0)
+    model = torch.nn.Linear(4, 1)
+    for x in batches:
+        sync = accumulator.add(torch.tensor(float(len(x))))
+        model(x).sum().backward() # summed over tokens, as the training losses are
+    assert sync
+    accumulator.normalize_grads(model.parameters())
+    assert accumulator.n_iters == 0
+    return model.weight.grad
+
+
+@pytest.mark.parametrize('normalize', [False, True])
+def test_grad_accumulator_matches_one_batch(normalize):
+    x = torch.randn(10, 4, generator=torch.Generator().manual_seed(1))
+    one_batch = accumulated_grad(GradAccumulator(normalize=normalize), [x])
+    two_micro_batches = accumulated_grad(GradAccumulator(iters=2, normalize=normalize), [x[:3], x[3:]])
+    assert torch.allclose(one_batch, two_micro_batches, atol=1e-6)
+    summed = accumulated_grad(GradAccumulator(), [x])
+    assert torch.allclose(one_batch, summed / len(x) if normalize else summed, atol=1e-6)
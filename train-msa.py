@@ -13,17 +13,18 @@ from torch.optim import Adam
 from torch.optim.lr_scheduler import LambdaLR
 from torch.utils.data import DataLoader
 import torch.distributed as dist
-from evodiff.collaters import D3PMCollaterMSA
-from evodiff.utils import Tokenizer
+from evodiff.collaters import D3PMCollaterMSA, d3pm_noise
+from evodiff.utils import Tokenizer, GradAccumulator, AsyncCheckpointer, autocast, PRECISIONS, broadcast_flag
 from evodiff.losses import  D3PMCELoss,  D3PMLVBLossMSA
+from evodiff.samplers import LossAwareTimestepSampler, MSABucketBatchSampler
 from evodiff.model import MSATransformerTime
 from sequence_models.esm import MSATransformer
 from sequence_models.constants import MSA_ALPHABET
-from evodiff.data import TRRMSADataset, A3MMSADataset
+from evodiff.data import TRRMSADataset, A3MMSADataset, MSAShardDataset
 from sequence_models.collaters import MSAAbsorbingCollater
 from sequence_models.samplers import SortishSampler, ApproxBatchSampler
 from sequence_models.losses import MaskedCrossEntropyLossMSA
-from evodiff.metrics import MaskedAccuracyMSA
+from evodiff.metrics import MaskedAccuracyMSA, MetricAccumulator
 from torch.utils.data import Subset
 from sequence_models.utils import warmup, transformer_lr
 
@@ -56,6 +57,12 @@ def main():
     parser.add_argument('--log-freq', type=float, default=1000)  # in steps
     parser.add_argument('--reweighting_term', type=float, default=0.001) # lambda from D3PM
     parser.add_argument('--selection-type', type=str, default='MaxHamming') # MaxHamming or random
+    parser.add_argument('--shards', action='store_true') # read openfold from write_msa_shards output in data dir
+    parser.add_argument('--device-noise', action='store_true') # D3PM noising in step on device, collater only tokenizes
+    parser.add_argument('--importance-sampling', action='store_true') # D3PM timesteps sampled by loss history
+    parser.add_argument('--bucket-batches', action='store_true') # openfold batches bucketed by (depth, length)
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS)) # autocast dtype of the model forward
+    parser.add_argument('--keep-checkpoints', type=int, default=None) # keep only the last N checkpoints written
 
 
     args = parser.parse_args()
@@ -106,6 +113,22 @@ def train(gpu, args):
         clip = config['clip']
     else:
         clip = np.inf
+    if 'accumulate' in config:
+        iters_to_accumulate = config['accumulate']
+    else:
+        iters_to_accumulate = 1 # dont accumulate
+    if 'accumulate_tokens' in config:
+        tokens_to_accumulate = config['accumulate_tokens'] # loss tokens per optimizer step over all gpus
+    else:
+        tokens_to_accumulate = None
+    if 'normalize_grads' in config:
+        normalize_grads = config['normalize_grads'] # mean instead of sum of the per token loss gradients per step
+    else:
+        normalize_grads = False
+    if 'max_cells' in config:
+        max_cells = config['max_cells'] # batch size * depth * length budget for --bucket-batches
+    else:
+        max_cells = np.inf
     if args.dataset is not None:
         config['dataset'] = args.dataset
 
@@ -121,10 +144,13 @@ def train(gpu, args):
         ptjob = False
 
     # build datasets, samplers, and loaders
+    timestep_sampler = None
     if args.mask == 'oadm':
         tokenizer = Tokenizer()
         collater = MSAAbsorbingCollater(alphabet=MSA_ALPHABET)
         diffusion_timesteps = None # Not input to model
+        if args.importance_sampling:
+            print("--importance-sampling only applies to D3PM timesteps, sampling OA-DM uniformly")
     elif args.mask == 'blosum' or args.mask == 'random':
         diffusion_timesteps = config['diffusion_timesteps']
         tokenizer = Tokenizer(path_to_blosum=data_top_dir+"blosum62-special-MSA.mat", sequences=False)
@@ -132,7 +158,13 @@ def train(gpu, args):
             Q_prod, Q_t = tokenizer.q_random_schedule(timesteps=diffusion_timesteps)
         if args.mask == 'blosum':
             Q_prod, Q_t = tokenizer.q_blosum_schedule(timesteps=diffusion_timesteps)
-        collater = D3PMCollaterMSA(tokenizer=tokenizer, num_timesteps=diffusion_timesteps, Q=Q_t, Q_bar=Q_prod)
+        if args.importance_sampling:
+            timestep_sampler = LossAwareTimestepSampler(diffusion_timesteps)
+        collater = D3PMCollaterMSA(tokenizer=tokenizer, num_timesteps=diffusion_timesteps, Q=Q_t, Q_bar=Q_prod,
+                                   onehot=False, noise=not args.device_noise, timestep_sampler=timestep_sampler)
+        if args.device_noise: # keep transition matrices resident on device
+            Q_t_device = Q_t.to(device)
+            Q_prod_device = Q_prod.to(device)
     else:
         print("mask must be: 'oadm', 'blosum', or 'random'")
 
@@ -150,7 +182,10 @@ def train(gpu, args):
         train_size = len(dataset)
         random_ind = np.random.choice(train_size, size=int(train_size * 0.8), replace=False)
     elif config['dataset'] == 'openfold':
-        dataset = A3MMSADataset(selection_type, n_sequences, max_seq_len, data_dir=data_dir, min_depth=min_depth)
+        if args.shards:
+            dataset = MSAShardDataset(selection_type, n_sequences, max_seq_len, data_dir=data_dir, min_depth=min_depth)
+        else:
+            dataset = A3MMSADataset(selection_type, n_sequences, max_seq_len, data_dir=data_dir, min_depth=min_depth)
         train_size = len(dataset)
         print("TRAIN SIZE:", train_size, rank)
         random_ind = np.random.choice(train_size, size=(train_size - 10000), replace=False)
@@ -163,7 +198,8 @@ def train(gpu, args):
         dl_train = DataLoader(dataset=ds_train,
                               batch_size=4,
                               collate_fn=collater,
-                              num_workers=8)
+                              num_workers=8,
+                              pin_memory=True)
     elif  config['dataset'] == 'openfold':
         #metadata = np.load(data_dir + config['dataset'] + '_lengths.npz')['ells']
         metadata = np.array(dataset.lengths)
@@ -173,35 +209,51 @@ def train(gpu, args):
 
         len_train = np.minimum(len_train, max_seq_len)
 
-        train_sortish_sampler = SortishSampler(len_train, bucket_size, num_replicas=args.world_size, rank=rank)
-        train_sampler = ApproxBatchSampler(train_sortish_sampler, max_tokens, max_batch_size, len_train,
-                                         max_square_tokens=max_square_tokens, msa_depth=n_sequences)
+        if args.bucket_batches:
+            depth_train = np.minimum(np.array(dataset.depths)[train_idx], n_sequences)
+            train_sampler = MSABucketBatchSampler(depth_train, len_train, max_cells, max_batch_size,
+                                                  max_tokens=max_tokens, max_square_tokens=max_square_tokens,
+                                                  bucket_size=bucket_size, num_replicas=args.world_size, rank=rank)
+        else:
+            train_sortish_sampler = SortishSampler(len_train, bucket_size, num_replicas=args.world_size, rank=rank)
+            train_sampler = ApproxBatchSampler(train_sortish_sampler, max_tokens, max_batch_size, len_train,
+                                             max_square_tokens=max_square_tokens, msa_depth=n_sequences)
         dl_train = DataLoader(dataset=ds_train,
                               batch_sampler=train_sampler,
                               collate_fn=collater,
-                              num_workers=8)
-
-    if rank == 0:
-        val_ind = np.delete(np.arange(train_size), random_ind)
-        ds_valid = Subset(dataset, val_ind)
-        if config['dataset'] == 'trrosetta':
-            dl_valid = DataLoader(dataset=ds_valid,
-                                  batch_size=4,
-                                  collate_fn=collater,
-                                  num_workers=8)
-        elif config['dataset'] == 'openfold':
-            valid_idx = ds_valid.indices
-            len_valid = metadata[valid_idx]
-            len_valid = np.minimum(len_valid, max_seq_len)
+                              num_workers=8,
+                              pin_memory=True)
 
+    # every rank validates its own shard of the split, the metrics are summed over ranks
+    val_ind = np.delete(np.arange(train_size), random_ind)
+    n_valid = len(val_ind)
+    ds_valid = Subset(dataset, val_ind[rank::args.world_size])
+    if config['dataset'] == 'trrosetta':
+        dl_valid = DataLoader(dataset=ds_valid,
+                              batch_size=4,
+                              collate_fn=collater,
+                              num_workers=8,
+                              pin_memory=True)
+    elif config['dataset'] == 'openfold':
+        valid_idx = ds_valid.indices
+        len_valid = metadata[valid_idx]
+        len_valid = np.minimum(len_valid, max_seq_len)
+
+        if args.bucket_batches:
+            depth_valid = np.minimum(np.array(dataset.depths)[valid_idx], n_sequences)
+            valid_sampler = MSABucketBatchSampler(depth_valid, len_valid, max_cells, max_batch_size,
+                                                  max_tokens=max_tokens, max_square_tokens=max_square_tokens,
+                                                  bucket_size=bucket_size)
+        else:
             valid_sortish_sampler = SortishSampler(len_valid, bucket_size, num_replicas=1, rank=0)
             valid_sampler = ApproxBatchSampler(valid_sortish_sampler, max_tokens, max_batch_size, len_valid,
                                               max_square_tokens=max_square_tokens, msa_depth=n_sequences)
 
-            dl_valid = DataLoader(dataset=ds_valid,
-                                  batch_sampler=valid_sampler,
-                                  collate_fn=collater,
-                                  num_workers=8)
+        dl_valid = DataLoader(dataset=ds_valid,
+                              batch_sampler=valid_sampler,
+                              collate_fn=collater,
+                              num_workers=8,
+                              pin_memory=True)
 
     # Initiate model
     if args.mask == 'oadm':
@@ -215,7 +267,10 @@ def train(gpu, args):
         scheduler = LambdaLR(optimizer, transformer_lr(warmup_steps))
     else:
         scheduler = LambdaLR(optimizer, warmup(warmup_steps))
-    scaler = GradScaler()
+    scaler = GradScaler(enabled=args.precision == 'fp16') # bf16 has the fp32 exponent range, no loss scaling
+    accumulator = GradAccumulator(iters=iters_to_accumulate, tokens=tokens_to_accumulate,
+                                  normalize=normalize_grads)
+    checkpointer = AsyncCheckpointer(keep=args.keep_checkpoints) # rank 0 writes checkpoints in the background
 
     outputs = os.listdir(args.out_fpath)
 
@@ -235,10 +290,13 @@ def train(gpu, args):
         model.load_state_dict(msd)
         optimizer.load_state_dict(sd['optimizer_state_dict'])
         scheduler.load_state_dict(sd['scheduler_state_dict'])
-        scaler.load_state_dict(sd['scaler_state_dict']),
+        if sd['scaler_state_dict']: # empty when saved without fp16 loss scaling
+            scaler.load_state_dict(sd['scaler_state_dict'])
         initial_epoch = sd['epoch'] + 1
         total_steps = sd['step']
         total_tokens = sd['tokens']
+        if timestep_sampler is not None and 'timestep_sampler_state_dict' in sd:
+            timestep_sampler.load_state_dict(sd['timestep_sampler_state_dict'])
     else:
         initial_epoch = 0
         total_steps = 0
@@ -251,8 +309,12 @@ def train(gpu, args):
         loss_func = MaskedCrossEntropyLossMSA(ignore_index=padding_idx)
     elif args.mask == 'blosum' or args.mask == 'random':
         # Austin = LVB + lambda * CE
-        loss_func1 = D3PMLVBLossMSA(tmax=diffusion_timesteps, tokenizer=tokenizer)
-        loss_func2 = D3PMCELoss(tokenizer=tokenizer, sequences=False)
+        if timestep_sampler is not None: # unreduced losses, reweighted per MSA in step
+            loss_func1 = D3PMLVBLossMSA(tmax=diffusion_timesteps, tokenizer=tokenizer, reduction='none')
+            loss_func2 = D3PMCELoss(tokenizer=tokenizer, sequences=False, reduction='none')
+        else:
+            loss_func1 = D3PMLVBLossMSA(tmax=diffusion_timesteps, tokenizer=tokenizer)
+            loss_func2 = D3PMCELoss(tokenizer=tokenizer, sequences=False)
         _lambda = args.reweighting_term
 
 
@@ -273,120 +335,108 @@ def train(gpu, args):
         else:
             # loader = dl_test
             t = "Testing"
-        ardm_losses = []
-        nll_losses = []
-        accus = []
-        ns = []
-        num_seqs = []
+        # summed on device, read back only when logging
+        metrics = MetricAccumulator(['ardm_loss', 'nll_loss', 'accu', 'n', 'seqs', 'processed'], device=device)
         chunk_time = datetime.now()
         weight_chunk_time = datetime.now()
         n_seen = 0
         tokens_trained = current_tokens
+        rloss_ardm = rloss_nll = raccu = 0.0
         if split == 'train':
             n_total = len(ds_train)
         elif split == 'valid':
-            n_total = len(ds_valid)
+            n_total = n_valid
         # else:
         #     n_total = len(ds_test)
+
+        def log(nsteps):
+            # one packed collective for all metrics since the last log, over all ranks
+            nonlocal n_seen, tokens_trained, rloss_ardm, rloss_nll, raccu
+            values, local = metrics.reduce(with_local=True)
+            if split == 'train':
+                n_seen += values['seqs']
+                tokens_trained += local['processed'] # this rank's count, the meaning of 'tokens' in checkpoints
+                metrics.reset() # training metrics are averaged over the log-freq window, validation over the epoch
+            else:
+                n_seen = values['seqs']
+            rloss_ardm = values['ardm_loss'] / values['n']
+            rloss_nll = values['nll_loss'] / values['n']
+            raccu = values['accu'] / values['n']
+            if rank == 0:
+                print('%s Epoch %d of %d Step %d Example %d of %d ardm_loss = %.4f nll_loss = %.4f accu = %.4f'
+                      % (t, e + 1, epochs, nsteps, n_seen, n_total, rloss_ardm, rloss_nll, raccu))
+
+        def save_checkpoint(nsteps):
+            with torch.no_grad():
+                ckpt_fpath = args.out_fpath + 'checkpoint%d.tar' % nsteps
+                ckpt = {
+                    'step': nsteps,
+                    'tokens': tokens_trained,
+                    'model_state_dict': model.state_dict(),
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'scheduler_state_dict': scheduler.state_dict(),
+                    'scaler_state_dict': scaler.state_dict(),
+                    'epoch': e,
+                    # 'amp_state_dict': amp.state_dict()
+                }
+                if timestep_sampler is not None:
+                    ckpt['timestep_sampler_state_dict'] = timestep_sampler.state_dict()
+                snapshot_time = checkpointer.save(ckpt, ckpt_fpath)
+                print('Checkpoint snapshot took %.2f s' % snapshot_time)
+
+        i = nsteps = 0 # a validation shard without batches still joins the final log
         for i, batch in enumerate(loader):
             if split == 'train' and i == 1 and e == initial_epoch and args.state_dict is not None:
                 optimizer.load_state_dict(sd['optimizer_state_dict'])
                 scheduler.load_state_dict(sd['scheduler_state_dict'])
-                scaler.load_state_dict(sd['scaler_state_dict'])
+                if sd['scaler_state_dict']:
+                    scaler.load_state_dict(sd['scaler_state_dict'])
             ardm_loss, nll_loss, new_accu, new_n, new_seqs, new_processed = step(model, batch, split)
-
-            if split == 'train':
-                dist.reduce(ardm_loss, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(nll_loss, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_accu, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_n, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_seqs, 0, op=dist.ReduceOp.SUM)
-            ardm_losses.append(ardm_loss.item())
-            nll_losses.append(nll_loss.item())
-            accus.append(new_accu.item())
-            ns.append(new_n.item())
-            num_seqs.append(new_seqs.item())
-            n_seen += new_seqs.item()
-            total_n = sum(ns)
-            total_s = sum(num_seqs)
-            rloss_ardm = sum(ardm_losses) / total_n
-            rloss_nll = sum(nll_losses) / total_n
-            raccu = sum(accus) / total_n
+            metrics.add(ardm_loss, nll_loss, new_accu, new_n, new_seqs, new_processed)
 
             if split == 'train':
                 # writer.add_scalar("Loss/train", rloss, e)
                 # writer.add_scalar("Acc/train", raccu, e)
                 nsteps = current_step + i + 1
-                tokens_trained += new_processed.item()
             else:
                 # writer.add_scalar("Loss/valid", rloss, e)
                 # writer.add_scalar("Acc/valid", raccu, e)
                 nsteps = i
-            if rank == 0:
-                if ptjob:
-                    end = '\n'
-                    start = ''
-                else:
-                    start = ''
-                    end = '\n'
-                print(
-                    start + '%s Epoch %d of %d Step %d Example %d of %d ardm_loss = %.4f nll_loss = %.4f accu = %.4f'
-                    % (t, e + 1, epochs, nsteps, n_seen, n_total, rloss_ardm, rloss_nll, raccu),
-                    end=end)
-                print('\n')
 
-            if split == 'train':
-                ardm_losses = ardm_losses[-999:]
-                nll_losses = nll_losses[-999:]
-                accus = accus[-999:]
-                ns = ns[-999:]
-                num_seqs = num_seqs[-999:]
-                if nsteps % args.log_freq == 0:
-                    if rank == 0:
-                        with open(args.out_fpath + 'metrics_train.csv', 'a') as f:
-                            #f.write(','.join(
-                            #    [str(rloss_ardm), str(rloss_nll), str(raccu), str(int(current_tokens)), str(current_step)]))
-                            #f.write('\n')  # Can add for train too
-                            f.write(','.join(
-                                [str(rloss_ardm), str(rloss_nll), str(raccu), str(int(current_tokens)),
-                                 str(nsteps), str(e)]))
-                            f.write('\n')
-                if datetime.now() - chunk_time > timedelta(minutes=args.checkpoint_freq):
+            # checkpoints are only considered at log steps, where tokens_trained is up to date
+            if split == 'train' and nsteps % args.log_freq == 0:
+                log(nsteps)
+                if rank == 0:
+                    with open(args.out_fpath + 'metrics_train.csv', 'a') as f:
+                        #f.write(','.join(
+                        #    [str(rloss_ardm), str(rloss_nll), str(raccu), str(int(current_tokens)), str(current_step)]))
+                        #f.write('\n')  # Can add for train too
+                        f.write(','.join(
+                            [str(rloss_ardm), str(rloss_nll), str(raccu), str(int(current_tokens)),
+                             str(nsteps), str(e)]))
+                        f.write('\n')
+                # rank 0's clock decides, every rank has to join the validation
+                if broadcast_flag(datetime.now() - chunk_time > timedelta(minutes=args.checkpoint_freq), device):
                     if rank == 0:
                         print('Training complete in ' + str(datetime.now() - chunk_time))
-                        with torch.no_grad():
-                            if rank == 0:
-                                ckpt_fpath = args.out_fpath + 'checkpoint%d.tar' % nsteps
-                                torch.save({
-                                    'step': nsteps,
-                                    'tokens': tokens_trained,
-                                    'model_state_dict': model.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'scaler_state_dict': scaler.state_dict(),
-                                    'epoch': e,
-                                    # 'amp_state_dict': amp.state_dict()
-                                }, ckpt_fpath)
-                                _ = epoch(model, e, split='valid', current_step=nsteps, current_tokens=tokens_trained)
-                        chunk_time = datetime.now()
-                        weight_chunk_time = datetime.now()
+                        save_checkpoint(nsteps)
+                    # all ranks validate their shard while the checkpoint is written, on the module so uneven shards
+                    # never meet a DDP collective
+                    with torch.no_grad():
+                        _ = epoch(model.module, e, split='valid', current_step=nsteps, current_tokens=tokens_trained)
+                    model.train()
+                    chunk_time = datetime.now()
+                    weight_chunk_time = datetime.now()
                 elif datetime.now() - weight_chunk_time > timedelta(minutes=args.weight_save_freq):
                     if rank == 0:
                         print('Saving weights ' + str(datetime.now() - chunk_time))
-                        with torch.no_grad():
-                            if rank == 0:
-                                ckpt_fpath = args.out_fpath + 'checkpoint%d.tar' % nsteps
-                                torch.save({
-                                    'step': nsteps,
-                                    'tokens': tokens_trained,
-                                    'model_state_dict': model.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'scaler_state_dict': scaler.state_dict(),
-                                    'epoch': e,
-                                    # 'amp_state_dict': amp.state_dict()
-                                }, ckpt_fpath)
+                        save_checkpoint(nsteps)
                         weight_chunk_time = datetime.now()
+        if split == 'train' and accumulator.n_iters > 0: # step on the partial window, no carry across epochs
+            accumulator.sync_grads(model.parameters())
+            optimizer_step(model)
+        if metrics.steps > 0 or split == 'valid': # rest of the epoch, every rank runs the same number of training steps
+            log(nsteps)
         if split == 'valid':
             if rank == 0:
                 with open(args.out_fpath + 'metrics.csv', 'a') as f:
@@ -397,24 +447,44 @@ def train(gpu, args):
                         [str(rloss_ardm), str(rloss_nll), str(raccu), str(int(current_tokens)),
                          str(current_step), str(e)]))
                     f.write('\n')
-            print('Validation complete in ' + str(datetime.now() - start_time))
+                print('Validation complete in ' + str(datetime.now() - start_time))
         print('Epoch complete in ' + str(datetime.now() - start_time))
         return i, tokens_trained
 
+    def optimizer_step(model):
+        scaler.unscale_(optimizer) # clip the true gradients, not the fp16 loss-scaled ones
+        accumulator.normalize_grads(model.parameters()) # sum over the window's tokens, or their mean if normalize_grads
+        _ = clip_grad_norm_(model.parameters(), clip)
+        scaler.step(optimizer)
+        scale = scaler.get_scale()
+        scaler.update()
+        skip_scheduler = (scale > scaler.get_scale())
+        if not skip_scheduler:
+           scheduler.step()
+
     def step(model, batch, split):
-        if args.mask == 'blosum' or args.mask == 'random':
-            src, src_one_hot, timestep, tgt, tgt_one_hot, Q, Q_prod, q = batch
-            src_one_hot = src_one_hot.to(device)
-            tgt_one_hot = tgt_one_hot.to(device)
-            q = q.to(device)
-            Q = Q.to(device)
-            Q_prod = Q_prod.to(device)
-            timestep = timestep.to(device)
+        weights = None
+        if timestep_sampler is not None: # importance weights are appended by the collater
+            *batch, weights = batch
+            weights = weights.to(device, non_blocking=True)
+        if (args.mask == 'blosum' or args.mask == 'random') and args.device_noise:
+            tgt, timestep = batch
+            tgt = tgt.to(device, non_blocking=True)
+            timestep = timestep.to(device, non_blocking=True)
+            src, q = d3pm_noise(tgt, timestep, Q_prod_device, tokenizer.K, padding_idx)
+            Q = Q_t_device
+            Q_prod = Q_prod_device
+        elif args.mask == 'blosum' or args.mask == 'random':
+            src, _, timestep, tgt, _, Q, Q_prod, q = batch # the LVB loss takes token ids, no one hots
+            q = q.to(device, non_blocking=True)
+            Q = Q.to(device, non_blocking=True)
+            Q_prod = Q_prod.to(device, non_blocking=True)
+            timestep = timestep.to(device, non_blocking=True)
         else:
             src, tgt, mask = batch
-            mask = mask.to(device)
-        src = src.to(device)
-        tgt = tgt.to(device)
+            mask = mask.to(device, non_blocking=True)
+        src = src.to(device, non_blocking=True)
+        tgt = tgt.to(device, non_blocking=True)
         input_mask = (src != masking_idx).float()
         nonpad_mask = (src != padding_idx).float()
         if args.mask == 'blosum' or args.mask == 'random':
@@ -426,32 +496,42 @@ def train(gpu, args):
         n_processed = input_mask.sum()
 
         if split == 'train':
-            optimizer.zero_grad()
+            if accumulator.n_iters == 0:
+                optimizer.zero_grad() # start of an accumulation window
+            sync = accumulator.add(n_tokens)
+        else:
+            sync = True
 
-        if args.mask == 'blosum' or args.mask == 'random':
-            outputs = model(src, timestep)
-            lvb_loss = loss_func1(src_one_hot, q, outputs, tgt, tgt_one_hot, nonpad_mask, timestep, Q, Q_prod)
-            ce_loss = loss_func2(outputs, tgt, nonpad_mask)
-            lvb_loss = lvb_loss.to(torch.float32)
-            ce_loss = ce_loss.to(torch.float32)
-            nll_loss = ce_loss * n_tokens
-            accu = accu_func(outputs, tgt, nonpad_mask) * n_tokens
-            loss = (lvb_loss + _lambda * ce_loss) * n_tokens
-        elif args.mask == 'oadm':
-            outputs = model(src)
-            ce_loss, nll_loss = loss_func(outputs, tgt, mask, nonpad_mask)
-            loss = ce_loss
-            accu = accu_func(outputs, tgt, mask) * n_tokens
+        with accumulator.sync(model, sync):
+            # Autocast only the model, the losses run in float32
+            with autocast(device, args.precision):
+                if args.mask == 'blosum' or args.mask == 'random':
+                    outputs = model(src, timestep)
+                else:
+                    outputs = model(src)
+            outputs = outputs.float()
+            if args.mask == 'blosum' or args.mask == 'random':
+                lvb_loss = loss_func1(src, q, outputs, tgt, None, nonpad_mask, timestep, Q, Q_prod)
+                ce_loss = loss_func2(outputs, tgt, nonpad_mask)
+                if weights is not None: # reweight per MSA so the losses stay unbiased
+                    if split == 'train':
+                        timestep_sampler.update(timestep, lvb_loss)
+                    lvb_loss = (lvb_loss * weights).mean()
+                    ce_loss = (ce_loss * weights.repeat_interleave(nonpad_mask.sum((1, 2)).long())).mean()
+                lvb_loss = lvb_loss.to(torch.float32)
+                ce_loss = ce_loss.to(torch.float32)
+                nll_loss = ce_loss * n_tokens
+                accu = accu_func(outputs, tgt, nonpad_mask) * n_tokens
+                loss = (lvb_loss + _lambda * ce_loss) * n_tokens
+            elif args.mask == 'oadm':
+                ce_loss, nll_loss = loss_func(outputs, tgt, mask, nonpad_mask)
+                loss = ce_loss
+                accu = accu_func(outputs, tgt, mask) * n_tokens
 
-        if split == 'train':
-            scaler.scale(loss).backward()
-            _ = clip_grad_norm_(model.parameters(), clip)
-            scaler.step(optimizer)
-            scale = scaler.get_scale()
-            scaler.update()
-            skip_scheduler = (scale > scaler.get_scale())
-            if not skip_scheduler:
-               scheduler.step()
+            if split == 'train':
+                scaler.scale(loss).backward()
+        if split == 'train' and sync:
+            optimizer_step(model)
 
         n_seqs = torch.tensor(len(src), device=device)
         return loss, nll_loss, accu, n_tokens, n_seqs, n_processed
@@ -461,9 +541,12 @@ def train(gpu, args):
         print('%d model parameters' % n_parameters)
     for e in range(initial_epoch, epochs):
         print("epoch: ", e + 1, rank)
+        if args.bucket_batches and config['dataset'] == 'openfold':
+            train_sampler.set_epoch(e)
         s, t = epoch(model, e, split='train', current_step=total_steps, current_tokens=total_tokens)
         total_steps += s
         total_tokens += t
+    checkpointer.wait()
 
 
 if __name__ == '__main__':
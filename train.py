@@ -15,14 +15,16 @@ import torch.distributed as dist
 from torch.cuda.amp import GradScaler
 
 from evodiff.model import ByteNetLMTime
-from evodiff.utils import Tokenizer
+from evodiff.utils import Tokenizer, GradAccumulator, AsyncCheckpointer, autocast, PRECISIONS, broadcast_flag
 from torch.utils.data import Subset
 from sequence_models.samplers import SortishSampler, ApproxBatchSampler
 from sequence_models.datasets import UniRefDataset
 from sequence_models.constants import MSA_ALPHABET
-from evodiff.collaters import OAMaskCollater, D3PMCollater
+from evodiff.collaters import OAMaskCollater, D3PMCollater, PackingCollater, d3pm_noise
 from evodiff.losses import OAMaskedCrossEntropyLoss, D3PMCELoss, D3PMLVBLoss
+from evodiff.samplers import LossAwareTimestepSampler, PackedBatchSampler
 from sequence_models.metrics import MaskedAccuracy
+from evodiff.metrics import MetricAccumulator
 from sequence_models.utils import warmup 
 import sys
 
@@ -63,6 +65,11 @@ def main():
     parser.add_argument('--reweighting_term', type=float, default=0)  # lambda reweighting term from Austin D3PM
     parser.add_argument('--random_seed', type=int, default=0)  # lambda reweighting term from Austin D3PM
     parser.add_argument('--pretrained', action='store_true') # ONLY USE THIS FLAG FOR FIRST RUN OF PRETRAIN
+    parser.add_argument('--device_noise', action='store_true') # D3PM noising in step on device, collater only tokenizes
+    parser.add_argument('--importance_sampling', action='store_true') # D3PM timesteps sampled by loss history
+    parser.add_argument('--pack_len', type=int, default=0) # if > 0, pack sequences into rows of this many positions
+    parser.add_argument('--precision', default='fp32', choices=list(PRECISIONS)) # autocast dtype of the model forward
+    parser.add_argument('--keep_checkpoints', type=int, default=None) # keep only the last N checkpoints written
 
     args = parser.parse_args()
     args.world_size = args.gpus * args.nodes
@@ -104,10 +111,22 @@ def train(gpu, args):
         activation = config['activation']
     else:
         activation = 'relu'
+    if 'ckpt_every' in config:
+        ckpt_every = config['ckpt_every'] # activation checkpointing, blocks per checkpointed segment
+    else:
+        ckpt_every = 0 # keep all activations
     if 'accumulate' in config:
         iters_to_accumulate = config['accumulate']
     else:
         iters_to_accumulate = 1 # dont accumulate
+    if 'accumulate_tokens' in config:
+        tokens_to_accumulate = config['accumulate_tokens'] # loss tokens per optimizer step over all gpus
+    else:
+        tokens_to_accumulate = None
+    if 'normalize_grads' in config:
+        normalize_grads = config['normalize_grads'] # mean instead of sum of the per token loss gradients per step
+    else:
+        normalize_grads = False
     bucket_size = config['bucket_size']
     max_tokens = config['max_tokens']
     max_batch_size = config['max_batch_size']
@@ -135,10 +154,13 @@ def train(gpu, args):
     # ----------------------------------------------------------
     ### COLLATORS ###
     # ----------------------------------------------------------
+    timestep_sampler = None
     if args.mask == 'oadm':
         tokenizer = Tokenizer()
         collater = OAMaskCollater(tokenizer=tokenizer)
         diffusion_timesteps = None # Not input to model
+        if args.importance_sampling:
+            print("--importance_sampling only applies to D3PM timesteps, sampling OA-DM uniformly")
     # elif args.mask == 'so':
     #     tokenizer = Tokenizer()
     #     raise Exception("Autoreg in other script")
@@ -151,9 +173,19 @@ def train(gpu, args):
             Q_prod, Q_t = tokenizer.q_random_schedule(timesteps=diffusion_timesteps)
         if args.mask == 'blosum':
             Q_prod, Q_t = tokenizer.q_blosum_schedule(timesteps=diffusion_timesteps)
-        collater = D3PMCollater(tokenizer=tokenizer, num_timesteps=diffusion_timesteps, Q=Q_t, Q_bar=Q_prod)
+        if args.importance_sampling:
+            timestep_sampler = LossAwareTimestepSampler(diffusion_timesteps)
+        # One hots are built on device in step, q_x is only used at tmax
+        collater = D3PMCollater(tokenizer=tokenizer, num_timesteps=diffusion_timesteps, Q=Q_t, Q_bar=Q_prod,
+                                dtype=torch.float32, onehot=False, noise=not args.device_noise,
+                                timestep_sampler=timestep_sampler)
+        if args.device_noise: # keep transition matrices resident on device
+            Q_t_device = Q_t.to(device)
+            Q_prod_device = Q_prod.to(device)
     else:
         print("mask must be: 'oadm', 'blosum', or 'random'")
+    if args.pack_len > 0: # batches are budgeted by sum of lengths and packed into rows in the model
+        collater = PackingCollater(collater, pack_len=args.pack_len)
     causal = False
     if args.mask == 'so':
         causal = True
@@ -172,37 +204,45 @@ def train(gpu, args):
                               shuffle=True,
                               batch_size=1,
                               num_workers=4,
-                              collate_fn=collater)
+                              collate_fn=collater,
+                              pin_memory=True)
     else:
         len_train = metadata['ells'][train_idx]
         train_sortish_sampler = SortishSampler(len_train, bucket_size, num_replicas=args.world_size, rank=rank)
-        train_sampler = ApproxBatchSampler(train_sortish_sampler, max_tokens, max_batch_size, len_train)
+        if args.pack_len > 0:
+            train_sampler = PackedBatchSampler(train_sortish_sampler, max_tokens, max_batch_size, len_train)
+        else:
+            train_sampler = ApproxBatchSampler(train_sortish_sampler, max_tokens, max_batch_size, len_train)
         dl_train = DataLoader(dataset=ds_train,
                           batch_sampler=train_sampler,
                           num_workers=16,
-                          collate_fn=collater)
-    if rank == 0:
-        ds_valid = UniRefDataset(data_dir, 'valid', structure=False)
-        valid_idx = ds_valid.indices
-        if args.mini_run:
-            vindices = np.arange(1, 80000, 1)
-            valid_indices = np.random.choice(vindices, mini_size)
-            len_valid = valid_indices
-            valid_sampler = Subset(ds_valid, valid_indices)
-            len_valid = valid_sampler
-            dl_valid = DataLoader(dataset=valid_sampler,
-                                  shuffle=True,
-                                  batch_size=1,
-                                  num_workers=4,
-                                  collate_fn=collater)
-        else:
-            len_valid = metadata['ells'][valid_idx]
-            valid_sortish_sampler = SortishSampler(len_valid, 1000, num_replicas=1, rank=0)
-            valid_sampler = ApproxBatchSampler(valid_sortish_sampler, max_tokens // 2, max_batch_size, len_valid)
-            dl_valid = DataLoader(dataset=ds_valid,
-                              batch_sampler=valid_sampler,
-                              num_workers=8,
-                              collate_fn=collater)
+                          collate_fn=collater,
+                          pin_memory=True)
+    # every rank validates its own shard of the split, the metrics are summed over ranks
+    ds_valid = UniRefDataset(data_dir, 'valid', structure=False)
+    valid_idx = ds_valid.indices
+    if args.mini_run:
+        vindices = np.arange(1, 80000, 1)
+        valid_indices = np.random.choice(vindices, mini_size)
+        len_valid = valid_indices
+        valid_sampler = Subset(ds_valid, valid_indices[rank::args.world_size])
+        dl_valid = DataLoader(dataset=valid_sampler,
+                              shuffle=True,
+                              batch_size=1,
+                              num_workers=4,
+                              collate_fn=collater,
+                              pin_memory=True)
+    else:
+        len_valid = metadata['ells'][valid_idx]
+        valid_shard = np.arange(len(ds_valid))[rank::args.world_size]
+        valid_sortish_sampler = SortishSampler(len_valid[valid_shard], 1000, num_replicas=1, rank=0)
+        valid_sampler = ApproxBatchSampler(valid_sortish_sampler, max_tokens // 2, max_batch_size,
+                                           len_valid[valid_shard])
+        dl_valid = DataLoader(dataset=Subset(ds_valid, valid_shard),
+                          batch_sampler=valid_sampler,
+                          num_workers=8,
+                          collate_fn=collater,
+                          pin_memory=True)
     # ----------------------------------------------------------
     # Initiate model
     # ----------------------------------------------------------
@@ -214,7 +254,7 @@ def train(gpu, args):
     model = ByteNetLMTime(n_tokens, d_embed, d_model, n_layers, kernel_size, r,
                       causal=causal, padding_idx=masking_idx, rank=weight_rank, dropout=args.dropout,
                       tie_weights=args.tie_weights, final_ln=args.final_norm, slim=slim, activation=activation,
-                      timesteps=diffusion_timesteps)
+                      timesteps=diffusion_timesteps, ckpt_every=ckpt_every)
     optimizer = Adam(model.parameters(), lr=lr, weight_decay=args.weight_decay)
     outputs = os.listdir(args.out_fpath)
     if len(outputs) > 0:
@@ -238,11 +278,16 @@ def train(gpu, args):
         initial_epoch = sd['epoch'] + 1
         total_steps = sd['step']
         total_tokens = sd['tokens']
+        if timestep_sampler is not None and 'timestep_sampler_state_dict' in sd:
+            timestep_sampler.load_state_dict(sd['timestep_sampler_state_dict'])
     else:
         initial_epoch = 0
         total_steps = 0
         total_tokens = 0
-    scaler = GradScaler()
+    scaler = GradScaler(enabled=args.precision == 'fp16') # bf16 has the fp32 exponent range, no loss scaling
+    accumulator = GradAccumulator(iters=iters_to_accumulate, tokens=tokens_to_accumulate,
+                                  normalize=normalize_grads)
+    checkpointer = AsyncCheckpointer(keep=args.keep_checkpoints) # rank 0 writes checkpoints in the background
     model = DDP(model)
     # ----------------------------------------------------------
     # Loss Function
@@ -255,8 +300,12 @@ def train(gpu, args):
         loss_func = OAMaskedCrossEntropyLoss(reweight=True)
     elif args.mask == 'blosum' or args.mask == 'random':
         # Austin = LVB + lambda * CE
-        loss_func1 = D3PMLVBLoss(tmax=diffusion_timesteps, tokenizer=tokenizer)
-        loss_func2 = D3PMCELoss(tokenizer=tokenizer)
+        if timestep_sampler is not None: # unreduced losses, reweighted per sequence in step
+            loss_func1 = D3PMLVBLoss(tmax=diffusion_timesteps, tokenizer=tokenizer, reduction='none')
+            loss_func2 = D3PMCELoss(tokenizer=tokenizer, reduction='none')
+        else:
+            loss_func1 = D3PMLVBLoss(tmax=diffusion_timesteps, tokenizer=tokenizer)
+            loss_func2 = D3PMCELoss(tokenizer=tokenizer)
         _lambda = args.reweighting_term
     accu_func = MaskedAccuracy()
     # ----------------------------------------------------------
@@ -272,14 +321,12 @@ def train(gpu, args):
             model = model.eval()
             loader = dl_valid
             t = 'Validating:'
-        losses = []
-        nll_losses = []
-        accus = []
-        ns = []
-        num_seqs = []
+        # summed on device, read back only when logging
+        metrics = MetricAccumulator(['loss', 'nll_loss', 'accu', 'n', 'seqs', 'processed'], device=device)
         chunk_time = datetime.now()
         n_seen = 0
         tokens_trained = current_tokens
+        r_loss = r_nll_loss = raccu = 0.0
         if train:
             if args.mini_run:
                 n_total = len(len_train)
@@ -290,6 +337,48 @@ def train(gpu, args):
                 n_total = len(len_valid)
             else:
                 n_total = len(ds_valid)
+
+        def log(nsteps):
+            # one packed collective for all metrics since the last log, over all ranks
+            nonlocal n_seen, tokens_trained, r_loss, r_nll_loss, raccu
+            values, local = metrics.reduce(with_local=True)
+            if train:
+                n_seen += values['seqs']
+                tokens_trained += local['processed'] # this rank's count, the meaning of 'tokens' in checkpoints
+                metrics.reset() # training metrics are averaged over the log_freq window, validation over the epoch
+            else:
+                n_seen = values['seqs']
+            r_loss = values['loss'] / values['n']
+            r_nll_loss = values['nll_loss'] / values['n']
+            raccu = values['accu'] / values['n']
+            if rank == 0:
+                print('%s Epoch %d of %d Step %d ntokens %d Example %d of %d loss = %.4f nll loss = %.4f accu = %.4f'
+                      % (t, e + 1, epochs, nsteps, tokens_trained, n_seen, n_total, r_loss, r_nll_loss, raccu))
+
+        def save_checkpoint(nsteps):
+            if rank == 0:
+                print('Writing to checkpoint at', chunk_time)
+                with torch.no_grad():
+                    ckpt_fpath = args.out_fpath + 'checkpoint%d.tar' % nsteps
+                    ckpt = {
+                        'step': nsteps,
+                        'tokens': tokens_trained,
+                        'model_state_dict': model.state_dict(),
+                        'optimizer_state_dict': optimizer.state_dict(),
+                        'scheduler_state_dict': scheduler.state_dict(),
+                        'epoch': e
+                    }
+                    if timestep_sampler is not None:
+                        ckpt['timestep_sampler_state_dict'] = timestep_sampler.state_dict()
+                    snapshot_time = checkpointer.save(ckpt, ckpt_fpath)
+                    print('Checkpoint snapshot took %.2f s' % snapshot_time)
+            # all ranks validate their shard while the checkpoint is written, on the module so uneven shards never
+            # meet a DDP collective
+            with torch.no_grad():
+                _ = epoch(model.module, False, current_step=nsteps, current_tokens=tokens_trained)
+            model.train()
+
+        i = nsteps = 0 # a validation shard without batches still joins the final log
         for i, batch in enumerate(loader):
             # restarting from a checkpoint
             if train and i == 1 and e == initial_epoch and args.state_dict is not None and not args.pretrained:
@@ -297,64 +386,28 @@ def train(gpu, args):
                 optimizer.load_state_dict(sd['optimizer_state_dict'])
                 scheduler.load_state_dict(sd['scheduler_state_dict'])
             new_loss, new_nll_loss, new_accu, new_n, new_seqs, new_processed = step(model, batch, train)
-            if train:
-                dist.reduce(new_loss, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_nll_loss, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_accu, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_n, 0, op=dist.ReduceOp.SUM)
-                dist.reduce(new_seqs, 0, op=dist.ReduceOp.SUM)
-            losses.append(new_loss.item())
-            nll_losses.append(new_nll_loss.item())
-            accus.append(new_accu.item())
-            ns.append(new_n.item())
-            num_seqs.append(new_seqs.item())
-            n_seen += new_seqs.item()
-            total_n = sum(ns)
-            r_loss = sum(losses) / total_n
-            r_nll_loss = sum(nll_losses) / total_n
-            raccu = sum(accus) / total_n
+            metrics.add(new_loss, new_nll_loss, new_accu, new_n, new_seqs, new_processed)
             if train:
                 nsteps = current_step + i + 1
-                tokens_trained += new_processed.item()
             else:
-                nsteps = i
-            if rank == 0:
-                if ptjob:
-                    end = '\n'
-                    start = ''
-                else:
-                    start = ''
-                    end = '\n'
-                print(start + '%s Epoch %d of %d Step %d ntokens %d Example %d of %d loss = %.4f nll loss = %.4f accu = %.4f'
-                      % (t, e + 1, epochs, nsteps, tokens_trained, n_seen, n_total, r_loss, r_nll_loss, raccu),
-                      end=end)
-            if train:
-                losses = losses[-999:]
-                accus = accus[-999:]
-                ns = ns[-999:]
-                num_seqs = num_seqs[-999:]
-                nll_losses = nll_losses[-999:]
-                if nsteps % args.log_freq == 0:  # write to checkpoint frequency
-                    if rank == 0:
-                        with open(args.out_fpath + 'train-metrics.csv', 'a') as f:
-                            f.write(','.join([str(r_loss), str(r_nll_loss), str(raccu), str(int(current_tokens)), str(nsteps), str(e)]))
-                            f.write('\n')
-                if ((datetime.now() - chunk_time) > timedelta(minutes=args.checkpoint_freq)) or (n_seen == n_total):
-                    if rank == 0:
-                        print('Writing to checkpoint at', chunk_time)
-                        with torch.no_grad():
-                            if rank == 0:
-                                ckpt_fpath = args.out_fpath + 'checkpoint%d.tar' % nsteps
-                                torch.save({
-                                    'step': nsteps,
-                                    'tokens': tokens_trained,
-                                    'model_state_dict': model.state_dict(),
-                                    'optimizer_state_dict': optimizer.state_dict(),
-                                    'scheduler_state_dict': scheduler.state_dict(),
-                                    'epoch': e
-                                }, ckpt_fpath)
-                                _ = epoch(model, False, current_step=nsteps, current_tokens=tokens_trained)
-                        chunk_time = datetime.now()
+                nsteps = i + 1
+            if train and nsteps % args.log_freq == 0:
+                log(nsteps)
+                if rank == 0:
+                    with open(args.out_fpath + 'train-metrics.csv', 'a') as f:
+                        f.write(','.join([str(r_loss), str(r_nll_loss), str(raccu), str(int(current_tokens)), str(nsteps), str(e)]))
+                        f.write('\n')
+                # rank 0's clock decides, every rank has to join the validation
+                if broadcast_flag((datetime.now() - chunk_time) > timedelta(minutes=args.checkpoint_freq), device):
+                    save_checkpoint(nsteps)
+                    chunk_time = datetime.now()
+        if train and accumulator.n_iters > 0: # step on the partial window, windows do not carry across epochs
+            accumulator.sync_grads(model.parameters())
+            optimizer_step(model)
+        if metrics.steps > 0 or not train: # rest of the epoch, every rank runs the same number of training steps
+            log(nsteps)
+        if train: # checkpoint at the end of every epoch
+            save_checkpoint(nsteps)
         if not train:
             if rank == 0:
                 with open(args.out_fpath + 'valid-metrics.csv', 'a') as f:
@@ -365,20 +418,42 @@ def train(gpu, args):
             print('Epoch complete in ' + str(datetime.now() - start_time))
         return i, tokens_trained
 
+    def optimizer_step(model):
+        scaler.unscale_(optimizer) # as in train-msa.py, gradients are unscaled before anything reads them
+        accumulator.normalize_grads(model.parameters()) # sum over the window's tokens, or their mean if normalize_grads
+        scaler.step(optimizer)
+        scale = scaler.get_scale()
+        scaler.update()
+        skip_scheduler = (scale > scaler.get_scale())
+        if not skip_scheduler:
+            scheduler.step()
+
     def step(model, batch, train):
-        if args.mask == 'blosum' or args.mask == 'random':
-            src, src_onehot, timestep, tgt, tgt_onehot, Q, Q_bar, q = batch
-            q = q.to(device)
-            Q = Q.to(device)
-            Q_bar = Q_bar.to(device)
-            src_onehot = src_onehot.to(device)
-            tgt_onehot = tgt_onehot.to(device)
+        pack = None
+        if args.pack_len > 0: # packing index is appended last by PackingCollater
+            *batch, pack = batch
+            pack = pack.to(device, non_blocking=True)
+        weights = None
+        if timestep_sampler is not None: # importance weights are appended by the collater
+            *batch, weights = batch
+            weights = weights.to(device, non_blocking=True)
+        if (args.mask == 'blosum' or args.mask == 'random') and args.device_noise:
+            tgt, timestep = batch
+            tgt = tgt.to(device, non_blocking=True)
+            timestep = timestep.to(device, non_blocking=True)
+            src, q = d3pm_noise(tgt, timestep, Q_prod_device, tokenizer.K, padding_idx)
+            Q, Q_bar = Q_t_device, Q_prod_device
+        elif args.mask == 'blosum' or args.mask == 'random':
+            src, _, timestep, tgt, _, Q, Q_bar, q = batch # the LVB loss takes token ids, no one hots
+            q = q.to(device, non_blocking=True)
+            Q = Q.to(device, non_blocking=True)
+            Q_bar = Q_bar.to(device, non_blocking=True)
         else:
             src, timestep, tgt, mask = batch
-            mask = mask.to(device)
-        timestep = timestep.to(device)
-        src = src.to(device)
-        tgt = tgt.to(device)
+            mask = mask.to(device, non_blocking=True)
+        timestep = timestep.to(device, non_blocking=True)
+        src = src.to(device, non_blocking=True)
+        tgt = tgt.to(device, non_blocking=True)
         input_mask = (src != padding_idx).float()
 
         if args.mask == 'blosum' or args.mask == 'random':
@@ -390,14 +465,25 @@ def train(gpu, args):
         n_seqs = torch.tensor(len(src), device=device)
         # step through model
         if train:
-            optimizer.zero_grad() # reset gradients of model parameters
+            if accumulator.n_iters == 0:
+                optimizer.zero_grad() # reset gradients of model parameters at the start of an accumulation window
+            sync = accumulator.add(n_tokens)
+        else:
+            sync = True
 
-        # Enables autocasting for the forward pass (model + loss)
-        with torch.cuda.amp.autocast(dtype=torch.float32):
-            outputs = model(src, timestep, input_mask=input_mask.unsqueeze(-1))
+        with accumulator.sync(model, sync):
+            # Autocast only the model, the losses run in float32
+            with autocast(device, args.precision):
+                outputs = model(src, timestep, input_mask=input_mask.unsqueeze(-1), pack_index=pack)
+            outputs = outputs.float()
             if args.mask == 'blosum' or args.mask == 'random':
-                lvb_loss = loss_func1(src_onehot, q, outputs, tgt, tgt_onehot, input_mask, timestep, Q, Q_bar)
+                lvb_loss = loss_func1(src, q, outputs, tgt, None, input_mask, timestep, Q, Q_bar)
                 ce_loss = loss_func2(outputs, tgt, input_mask)
+                if weights is not None: # reweight per sequence so the losses stay unbiased
+                    if train:
+                        timestep_sampler.update(timestep, lvb_loss)
+                    lvb_loss = (lvb_loss * weights).mean()
+                    ce_loss = (ce_loss * weights.repeat_interleave(input_mask.sum(1).long())).mean()
                 lvb_loss = lvb_loss.to(torch.float32)
                 ce_loss = ce_loss.to(torch.float32)
                 loss = (lvb_loss + (_lambda * ce_loss)) * n_tokens
@@ -407,28 +493,10 @@ def train(gpu, args):
                 ce_loss, nll_loss = loss_func(outputs, tgt, mask, timestep, input_mask)  # sum(loss per token)
                 loss = ce_loss
                 accu = accu_func(outputs, tgt, mask) * n_tokens
-        if train:
-            # Exit the context manager before backward()
-            scaler.scale(loss).backward()
-            scaler.step(optimizer)
-            scale = scaler.get_scale()
-            scaler.update()
-            skip_scheduler = (scale > scaler.get_scale())
-            if not skip_scheduler:
-                scheduler.step()
-
-            # Gradient accumulation
-            #print("batch", i)
-            # if (i + 1) % iters_to_accumulate == 0: # If not accumulating gradients iters_to_accumulate = 1
-            #     #print("accumulating every", iters_to_accumulate)
-            #     #print("updating gradients at batch", i)
-            #     scaler.step(optimizer)
-            #     scale = scaler.get_scale()
-            #     scaler.update()
-            #
-            #     skip_scheduler = (scale > scaler.get_scale())
-            #     if not skip_scheduler:
-            #        scheduler.step()
+            if train:
+                scaler.scale(loss).backward()
+        if train and sync:
+            optimizer_step(model)
         if loss <= 0 or loss >= 1000000:
             print(loss, lvb_loss, ce_loss, nll_loss, n_tokens, _lambda)
             print(timestep)
@@ -449,6 +517,7 @@ def train(gpu, args):
         s, t = epoch(model, True, current_step=total_steps, current_tokens=total_tokens)
         total_steps += s
         total_tokens += t
+    checkpointer.wait()
 
 if __name__ == '__main__':
     main()